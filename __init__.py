@@ -8,41 +8,95 @@ It depends on:
 - mmdc to convert mermaid chart to svg. See: https://mermaid-js.github.io/mermaid/#
 """
 
-from importlib.metadata import version
-
-__version__ = version("k3down2")
 __name__ = "k3down2"
 
+from .async_down2 import (
+    async_convert,
+    async_render_to_img,
+    async_shutdown,
+)
+from .cache import ResultCache
 from .down2 import (
+    ConversionPlan,
+    Converter,
+    browser_stats,
     code_to_html,
+    compile_plan,
+    conversion_route,
     convert,
+    convert_multi,
     download,
     graphviz_to_img,
     md_to_html,
+    md_to_html_many,
     mdtable_to_barehtml,
+    mdtable_to_barehtml_many,
     mermaid_to_svg,
+    page_pool_stats,
+    register_converter,
+    render_many,
     render_to_img,
+    set_browser_recycle,
+    set_page_pool_size,
+    set_pandoc_backend,
+    set_result_cache,
+    set_stage_hook,
     tex_to_img,
     tex_to_plain,
     tex_to_zhihu,
     tex_to_zhihu_compatible,
     tex_to_zhihu_url,
+    warmup,
     web_to_img,
 )
+from .farm import RenderFarm
+from .pandoc_server import PandocServer
 
 __all__ = [
+    "ConversionPlan",
+    "Converter",
+    "PandocServer",
+    "RenderFarm",
+    "ResultCache",
+    "async_convert",
+    "async_render_to_img",
+    "async_shutdown",
+    "browser_stats",
     "code_to_html",
+    "compile_plan",
+    "conversion_route",
     "convert",
+    "convert_multi",
     "download",
     "graphviz_to_img",
     "md_to_html",
+    "md_to_html_many",
     "mdtable_to_barehtml",
+    "mdtable_to_barehtml_many",
     "mermaid_to_svg",
+    "page_pool_stats",
+    "register_converter",
+    "render_many",
     "render_to_img",
+    "set_browser_recycle",
+    "set_page_pool_size",
+    "set_pandoc_backend",
+    "set_result_cache",
+    "set_stage_hook",
     "tex_to_img",
     "tex_to_plain",
     "tex_to_zhihu",
     "tex_to_zhihu_compatible",
     "tex_to_zhihu_url",
+    "warmup",
     "web_to_img",
 ]
+
+
+def __getattr__(name: str):
+    # importlib.metadata is slow to import, thus the version is looked up on demand.
+    if name == "__version__":
+        from importlib.metadata import version
+
+        return version("k3down2")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Asyncio counterparts of ``convert`` and ``render_to_img``, built on the async Playwright API.
+Renders run concurrently on the event loop and share one browser of the loop.
+Conversions without a browser, such as pandoc or download, run in the default executor.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import functools
+import os
+import pathlib
+import tempfile
+import weakref
+from typing import TYPE_CHECKING, BinaryIO, Callable
+
+from . import down2
+
+# asyncio and playwright are imported when used, to keep ``import k3down2`` fast.
+if TYPE_CHECKING:
+    from playwright.async_api import Browser, Page
+
+# The playwright and the browser of every event loop: async playwright objects are bound to the loop that created them.
+_instances: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+async def _get_browser() -> Browser:
+    inst = await _instance()
+    async with inst["lock"]:
+        if inst["browser"] is None:
+            if inst["playwright"] is None:
+                from playwright.async_api import async_playwright
+
+                inst["playwright"] = await async_playwright().start()
+            inst["browser"] = await inst["playwright"].chromium.launch()
+    return inst["browser"]
+
+
+async def _instance() -> dict:
+    """Return the playwright and the browser of the running loop, which are None until they are launched."""
+
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    inst = _instances.get(loop)
+    if inst is None:
+        inst = {"lock": asyncio.Lock(), "playwright": None, "browser": None}
+        # Closed when the loop shuts down its async generators, e.g. at the end of ``asyncio.run()``.
+        inst["guard"] = _close_at_shutdown(inst)
+        await inst["guard"].__anext__()
+        _instances[loop] = inst
+    return inst
+
+
+async def _close_at_shutdown(inst: dict):
+    try:
+        yield
+    finally:
+        await _close(inst)
+
+
+async def _close(inst: dict) -> None:
+    browser, inst["browser"] = inst["browser"], None
+    playwright, inst["playwright"] = inst["playwright"], None
+    if browser is not None:
+        await browser.close()
+    if playwright is not None:
+        await playwright.stop()
+
+
+async def async_shutdown() -> None:
+    """
+    Close the browser used by ``async_render_to_img`` on the running event loop.
+    It is also closed when the loop shuts down, e.g. at the end of ``asyncio.run()``.
+    """
+
+    import asyncio
+
+    inst = _instances.pop(asyncio.get_running_loop(), None)
+    if inst is not None:
+        await inst["guard"].aclose()
+
+
+async def async_render_to_img(
+    mime: str,
+    content: str | bytes,
+    typ: str,
+    width: int = 1000,
+    height: int = 2000,
+    asset_base: str | None = None,
+    via_file: bool = False,
+    clip: bool = False,
+    full_page: bool = False,
+    trim_tolerance: int = 0,
+    quality: int = 75,
+    lossless: bool = False,
+    png_profile: str | dict | None = None,
+    scale: float = 2,
+    target_width: int | None = None,
+    max_bytes: int | None = None,
+    downscale: bool = False,
+    info: dict | None = None,
+    out: str | os.PathLike | BinaryIO | None = None,
+    hook: Callable[[str, str, dict], object] | None = None,
+) -> bytes | None:
+    """
+    Render content that is renderable in a browser to image, like ``render_to_img`` does,
+    without blocking the event loop.
+    It accepts the same arguments as ``render_to_img()``.
+
+    Args:
+        mime(str): a full mime type such as ``image/jpeg`` or a shortcut ``jpg``.
+
+        content(str): content to render, such as jpeg data or svg source.
+
+        typ(string): specifies output image type: "png", "jpg", "webp" or "avif".
+
+        width(int): specifies the window width to render a page. Default 1000.
+
+        height(int): specifies the window height to render a page. Default 2000.
+
+        asset_base(str): specifies the path to assets dir. E.g. the image base path in a html page.
+
+        via_file(bool): load content from a temp file, see ``render_to_img()``. Default False.
+
+        clip(bool): capture only the area of the painted content, see ``render_to_img()``. Default False.
+
+        full_page(bool): capture content taller than the window in one pass. Default False.
+
+        trim_tolerance(int): max difference of a border pixel from the background color to trim. Default 0.
+
+        quality(int): jpg, lossy webp or lossy avif quality from 0 to 100. Default 75.
+
+        lossless(bool): encode webp losslessly, or avif nearly losslessly. Default False.
+
+        png_profile(str|dict): how to encode a png, see ``render_to_img()``.
+
+        scale(float): device scale factor, i.e. image pixels per CSS pixel. Default 2.
+
+        target_width(int): the width in pixels of the output image, see ``render_to_img()``. Default None.
+
+        max_bytes(int): max size of a jpg output, see ``render_to_img()``. Default None.
+
+        downscale(bool): reduce the size of a jpg that does not fit ``max_bytes``. Default False.
+
+        info(dict): to store the ``width``, ``height``, ``scale`` and ``quality`` of the output. Default None.
+
+        out(str|PathLike|BinaryIO): a path or a writable binary stream to write the image to. Default None.
+
+        hook(callable): ``hook(event, stage, info)`` to report the timing of the stages, see ``set_stage_hook()``.
+
+    Returns:
+        bytes of the image data, or None if ``out`` is specified.
+    """
+
+    import asyncio
+
+    if hook is None:
+        hook = down2._current_stage_hook()
+
+    typs = [typ]
+    m, content, suffix = down2._prepare_content(mime, content, asset_base, via_file)
+    png_options = down2._check_render_options(typs, scale, target_width, max_bytes, png_profile)
+
+    if target_width is not None:
+        with down2._Stage(hook, "render_to_img.measure"):
+            async with _page(width, height, 1) as page:
+                await _load_content(page, m, content, suffix, asset_base, via_file, hook)
+                box = down2._box_of(await page.evaluate(down2._content_box_js))
+                if box is not None:
+                    content_width = box["width"]
+                else:
+                    content_width = await page.evaluate("document.documentElement.scrollWidth")
+        scale = down2._scale_for_width(target_width, content_width)
+
+    if info is not None:
+        info["scale"] = scale
+
+    jpeg_quality = down2._browser_jpeg_quality(typs, quality, target_width, max_bytes)
+    with down2._Stage(hook, "render_to_img.render") as stage_info:
+        async with _page(width, height, scale) as page:
+            await _load_content(page, m, content, suffix, asset_base, via_file, hook)
+
+            box = None
+            with down2._Stage(hook, "render_to_img.layout"):
+                if clip:
+                    box = down2._box_of(await page.evaluate(down2._content_box_js))
+                screenshot_args = down2._screenshot_args(clip, box, full_page, jpeg_quality)
+
+                if box is None and not full_page:
+                    content_height = await page.evaluate("document.documentElement.scrollHeight")
+                    if content_height > height:
+                        await page.set_viewport_size({"width": width, "height": content_height})
+
+            with down2._Stage(hook, "render_to_img.screenshot") as screenshot_info:
+                data = await page.screenshot(**screenshot_args)
+                screenshot_info["bytes"] = len(data)
+        stage_info["bytes"] = len(data)
+
+    loop = asyncio.get_running_loop()
+    encode = functools.partial(
+        down2._encode_screenshot,
+        data,
+        box,
+        typs,
+        jpeg_quality=jpeg_quality,
+        trim_tolerance=trim_tolerance,
+        quality=quality,
+        lossless=lossless,
+        png_options=png_options,
+        target_width=target_width,
+        max_bytes=max_bytes,
+        downscale=downscale,
+        info=info,
+        outs=[out],
+        hook=hook,
+    )
+    return (await loop.run_in_executor(None, encode))[0]
+
+
+@contextlib.asynccontextmanager
+async def _page(width: int, height: int, scale: float):
+    browser = await _get_browser()
+    page = await browser.new_page(viewport={"width": width, "height": height}, device_scale_factor=scale)
+    try:
+        yield page
+    finally:
+        await page.close()
+
+
+async def _load_content(
+    page: Page,
+    mime: str,
+    content: str | bytes,
+    suffix: str,
+    asset_base: str | None,
+    via_file: bool,
+    hook: Callable[[str, str, dict], object] | None,
+) -> None:
+    """Load content in a page from memory, or from a temp file if ``via_file``, like ``down2._load_content()``."""
+
+    import asyncio
+
+    if not via_file:
+        doc: dict = {}
+
+        async def serve(route):
+            await route.fulfill(**down2._document_response(doc, route.request.url))
+
+        await page.route(down2._document_origin + "/**", serve)
+        with down2._Stage(hook, "render_to_img.goto"):
+            await page.goto(down2._init_document(doc, mime, content, suffix, asset_base))
+        return
+
+    with tempfile.TemporaryDirectory() as tdir:
+        fn = os.path.join(tdir, "xxx." + suffix)
+        with down2._Stage(hook, "render_to_img.write_file") as info:
+            info["bytes"] = await asyncio.to_thread(_write_file, fn, content)
+
+        with down2._Stage(hook, "render_to_img.goto"):
+            await page.goto(pathlib.Path(fn).as_uri())
+
+
+def _write_file(fn: str, content: str | bytes) -> int:
+    with open(fn, "wb" if isinstance(content, bytes) else "w") as f:
+        f.write(content)
+    return os.path.getsize(fn)
+
+
+async def async_convert(
+    input_typ: str,
+    content: str | bytes | os.PathLike,
+    output_typ: str,
+    opt: dict[str, dict] | None = None,
+    out: str | os.PathLike | BinaryIO | None = None,
+    hook: Callable[[str, str, dict], object] | None = None,
+) -> str | bytes | None:
+    """
+    Convert ``content`` from ``input_typ`` to ``output_typ``, like ``convert`` does, without blocking the event loop.
+    It takes the same route and arguments as ``convert``, shares the plans and the result cache with it,
+    see ``set_result_cache()``, and reports the same stages to ``hook``.
+    Converters that render with ``render_to_img`` are run by ``async_render_to_img``,
+    other converters, including ones replaced by ``register_converter``, run in the default executor.
+
+    Returns:
+        the converted content, or None if ``out`` is specified.
+    """
+
+    import asyncio
+
+    plan = down2._get_plan(input_typ, output_typ, opt)
+
+    if hook is None:
+        hook = down2._current_stage_hook()
+    # Let ``async_render_to_img`` and ``render_to_img`` in a step find the hook.
+    token = down2._stage_hook.set(hook)
+    try:
+        cache = down2._result_cache
+        if cache is None or not plan._cacheable:
+            return await _run_plan(plan, content, out, hook)
+
+        key = await asyncio.to_thread(plan._cache_key, content)
+        with down2._Stage(hook, "convert.cache") as info:
+            result = await asyncio.to_thread(cache.get, key)
+            info["hit"] = result is not None
+        if result is None:
+            result = await _run_plan(plan, content, None, hook)
+            await asyncio.to_thread(cache.put, key, result)
+    finally:
+        down2._stage_hook.reset(token)
+
+    if out is None:
+        return result
+    return await asyncio.to_thread(down2._write_out, out, lambda f: f.write(down2.to_bytes(result)))
+
+
+async def _run_plan(
+    plan: down2.ConversionPlan,
+    content: str | bytes | os.PathLike,
+    out: str | os.PathLike | BinaryIO | None,
+    hook: Callable[[str, str, dict], object] | None,
+) -> str | bytes | None:
+    """Run the steps of a plan like ``ConversionPlan`` does."""
+
+    import asyncio
+
+    *convs, last_conv = plan.converters
+    *steps, last = plan._steps
+    for conv, step in zip(convs, steps):
+        content = await _run_step(hook, conv, step, content)
+
+    if out is None:
+        return await _run_step(hook, last_conv, last, content)
+    if last_conv.sink:
+        return await _run_step(hook, last_conv, last, content, out=out)
+    result = await _run_step(hook, last_conv, last, content)
+    return await asyncio.to_thread(down2._write_out, out, lambda f: f.write(down2.to_bytes(result)))
+
+
+async def _run_step(
+    hook: Callable[[str, str, dict], object] | None, conv: down2.Converter, step: Callable, content, **kwargs
+) -> str | bytes | None:
+    """
+    Run a step of a plan, reported to ``hook``.
+    A step that renders with ``render_to_img``, i.e. a partial of it, with ``opt`` bound, is run by
+    ``async_render_to_img``.
+    """
+
+    import asyncio
+
+    if isinstance(step, functools.partial) and step.func is down2.render_to_img:
+        call = async_render_to_img(*step.args, content, **step.keywords, **kwargs)
+    else:
+        call = asyncio.to_thread(step, content, **kwargs)
+
+    if hook is None:
+        return await call
+
+    with down2._step_stage(hook, conv, content) as info:
+        result = await call
+        size = down2._size(result)
+        if size is not None:
+            info["bytes"] = size
+    return result
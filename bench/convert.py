@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Time every conversion from an input type to an output type, along the route ``convert`` takes,
+on small, medium and huge inputs, and report throughput, p50/p99 latency and the peak of Python memory of each.
+
+The zhihu equation endpoint is replaced by a local HTTP server, thus the "url" conversions
+do not depend on the network; ``--latency`` adds a delay to every response to mimic a remote one.
+The stand-in serves svg, thus ``url->jpg``, ``url->png`` and ``url->html``, which only download the url,
+are not run: they would time the download of an svg.
+A conversion whose backend is missing, e.g. ``mmdc`` or ``dot``, is reported as skipped.
+
+Memory is measured by ``tracemalloc`` in an extra call, so that it does not slow down the timed calls.
+It covers the Python side only: pandoc, dot and the browser run in other processes,
+whose max RSS is printed at the end.
+
+Usage:
+    python bench/convert.py [-n ROUNDS] [--sizes small,medium,huge] [--pairs 'table->*,tex_inline->png']
+                            [--save FILE] [--baseline FILE] [--threshold 1.2]
+"""
+
+import argparse
+import fnmatch
+import http.server
+import json
+import platform
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+from k3down2 import down2
+
+sizes = {"small": 1, "medium": 10, "huge": 100}
+
+
+def table_input(n):
+    rows = ["| name | type | description |", "| :--- | :--: | ---: |"]
+    for i in range(4 * n):
+        rows.append(f"| field_{i} | `int{i % 64}` | the **{i}th** field, see [doc](http://example.com/{i}) |")
+    return "\n".join(rows) + "\n"
+
+
+def code_input(n):
+    lines = ["```python"]
+    for i in range(10 * n):
+        lines.append(f"def f{i}(x: int, y: str = 'k3down2') -> dict:  # comment {i}")
+        lines.append(f"    return {{'x': x * {i}, 'y': y.upper()}}")
+    lines.append("```")
+    return "\n".join(lines) + "\n"
+
+
+def md_input(n):
+    parts = []
+    for i in range(n):
+        parts.append(f"## Section {i}\n")
+        parts.append(f"Some *emphasized* text, `inline code` and a [link](http://example.com/{i}).\n")
+        parts.append("- item one\n- item two\n  - nested item\n")
+        parts.append(table_input(1))
+    return "\n".join(parts)
+
+
+def mermaid_input(n):
+    lines = ["graph LR"]
+    for i in range(5 * n):
+        lines.append(f"    n{i}[node {i}] --> n{i + 1}[node {i + 1}]")
+    return "\n".join(lines) + "\n"
+
+
+def graphviz_input(n):
+    lines = ["digraph G {", "    node [shape=box];"]
+    for i in range(5 * n):
+        lines.append(f'    n{i} -> n{i + 1} [label="e{i}"];')
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def tex_input(n):
+    terms = " + ".join(f"\\frac{{x_{i}^2}}{{\\sqrt{{y_{i}}}}}" for i in range(3 * n))
+    return f"\\sum_{{i=1}}^{{n}} {terms}"
+
+
+def svg_input(n):
+    k = 5 * n
+    shapes = []
+    for i in range(k):
+        shapes.append(f'<rect x="10" y="{10 + i * 30}" width="200" height="20" fill="#f2f3f3" stroke="#b6b6b6"/>')
+        shapes.append(f'<text x="20" y="{25 + i * 30}" font-size="14">row {i}</text>')
+    return f'<svg xmlns="http://www.w3.org/2000/svg" width="240" height="{20 + k * 30}">' + "".join(shapes) + "</svg>"
+
+
+def html_input(n):
+    return down2.html_style + down2.code_to_html(code_input(n))
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    """
+    A local stand-in of the zhihu equation endpoint: ``/equation?tex=...`` responds an svg
+    whose width grows with the tex, like the real one.
+    """
+
+    latency = 0.0
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+        tex = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).get("tex", [""])[0]
+        body = (
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{20 + 8 * len(tex)}" height="40">'
+            f'<text x="10" y="25" font-size="16">{len(tex)} chars of tex</text></svg>'
+        ).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/svg+xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stand_in(latency: float) -> http.server.ThreadingHTTPServer:
+    StandIn.latency = latency
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    host, port = server.server_address
+    down2.zhihu_equation_url_fmt = f"http://{host}:{port}/equation?tex={{texurl}}{{align}}"
+    return server
+
+
+def make_inputs(n: int) -> dict:
+    inputs = {
+        "table": table_input(n),
+        "code": code_input(n),
+        "md": md_input(n),
+        "mermaid": mermaid_input(n),
+        "graphviz": graphviz_input(n),
+        "tex_block": tex_input(n),
+        "tex_inline": tex_input(n),
+        "svg": svg_input(n),
+    }
+    # After the stand-in is started, the urls point to it.
+    inputs["url"] = down2.tex_to_zhihu_url(inputs["tex_block"], True)
+    inputs["html"] = html_input(n)
+    return inputs
+
+
+def percentile(sorted_samples: list, p: float) -> float:
+    """The ``p``-th percentile by linear interpolation between the closest ranks."""
+    k = (len(sorted_samples) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_samples) - 1)
+    return sorted_samples[lo] + (sorted_samples[hi] - sorted_samples[lo]) * (k - lo)
+
+
+def bench_one(conv, content, rounds: int) -> dict:
+    """Time ``conv(content)``, where ``conv`` is a compiled plan of a route, see ``compile_plan()``."""
+
+    # The first call launches the browser or warms the tool, and tells whether the backend is there.
+    conv(content)
+
+    samples = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        conv(content)
+        samples.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    try:
+        conv(content)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    samples.sort()
+    total = sum(samples)
+    size = len(down2.to_bytes(content))
+    return {
+        "rounds": rounds,
+        "input_bytes": size,
+        "p50": percentile(samples, 50),
+        "p99": percentile(samples, 99),
+        "mean": statistics.fmean(samples),
+        "ops": rounds / total if total else float("inf"),
+        "throughput": size * rounds / total if total else float("inf"),
+        "peak_memory": peak,
+    }
+
+
+def select_pairs(patterns: list[str] | None) -> list[tuple[str, str]]:
+    """Return every pair of an input type and an output type that ``convert`` has a route for."""
+
+    input_typs = sorted({frm for frm, _ in down2.mappings})
+    output_typs = sorted({to for _, to in down2.mappings})
+
+    pairs = []
+    for frm in input_typs:
+        for to in output_typs:
+            if frm == to:
+                continue
+            name = f"{frm}->{to}"
+            if patterns and not any(fnmatch.fnmatchcase(name, p) for p in patterns):
+                continue
+            try:
+                route = down2.conversion_route(frm, to)
+            except ValueError:
+                continue
+            if frm == "url" and to != "svg" and [c.fn for c in route] == [down2.download]:
+                # A download of the svg served by the stand-in, not a conversion to ``to``.
+                continue
+            pairs.append((frm, to))
+    return pairs
+
+
+def compare(result: dict, base: dict | None, threshold: float) -> tuple[str, bool]:
+    """Return the change of p50 against the baseline and whether it is a regression."""
+
+    if base is None or "p50" not in base or "p50" not in result:
+        return "", False
+    ratio = result["p50"] / base["p50"] if base["p50"] else float("inf")
+    return f"{(ratio - 1) * 100:+.0f}%", ratio > threshold
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="benchmark every conversion route")
+    parser.add_argument("-n", type=int, default=10, help="number of timed rounds of every case, default 10")
+    parser.add_argument("--sizes", default="small,medium", help="small, medium or huge, default small,medium")
+    parser.add_argument("--pairs", help="comma separated glob patterns of the conversions to run, e.g. 'table->*'")
+    parser.add_argument("--latency", type=float, default=0, help="delay in ms of the equation stand-in, default 0")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline in json")
+    parser.add_argument("--baseline", metavar="FILE", help="compare the p50 latency with a saved baseline")
+    parser.add_argument(
+        "--threshold", type=float, default=1.2, help="p50 ratio to the baseline reported as a regression, default 1.2"
+    )
+    args = parser.parse_args()
+
+    size_names = args.sizes.split(",")
+    for name in size_names:
+        if name not in sizes:
+            parser.error(f"invalid size: {name}")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    server = start_stand_in(args.latency / 1000)
+    pairs = select_pairs(args.pairs.split(",") if args.pairs else None)
+
+    results = {}
+    regressions = []
+
+    print(
+        f"{'case':<28} {'p50 ms':>9} {'p99 ms':>9} {'ops/s':>8} {'in KB/s':>9} {'peak KB':>9} {'vs base':>8}",
+        flush=True,
+    )
+    try:
+        for size_name in size_names:
+            inputs = make_inputs(sizes[size_name])
+
+            for frm, to in pairs:
+                case = f"{frm}->{to}/{size_name}"
+                if frm not in inputs:
+                    print(f"{case:<28} skipped: no input of {frm}")
+                    continue
+
+                try:
+                    r = bench_one(down2.compile_plan(frm, to), inputs[frm], args.n)
+                except Exception as e:
+                    results[case] = {"error": repr(e)}
+                    reason = repr(e).splitlines()[0]
+                    print(f"{case:<28} skipped: {reason}"[:120])
+                    continue
+
+                results[case] = r
+                change, regressed = compare(r, baseline.get(case), args.threshold)
+                if regressed:
+                    regressions.append(case)
+                    change += " !"
+                print(
+                    f"{case:<28} {r['p50'] * 1000:>9.2f} {r['p99'] * 1000:>9.2f} {r['ops']:>8.1f}"
+                    f" {r['throughput'] / 1024:>9.1f} {r['peak_memory'] / 1024:>9.1f} {change:>8}",
+                    flush=True,
+                )
+    finally:
+        server.shutdown()
+
+    # ru_maxrss is in KB on Linux and in bytes on macOS.
+    unit = 1 if sys.platform == "darwin" else 1024
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+    print(f"max RSS: this process {self_rss / (1 << 20):.1f} MB, a child process {children_rss / (1 << 20):.1f} MB")
+
+    if args.save:
+        meta = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "rounds": args.n,
+            "versions": {b: down2._backend_version(b) for b in ("k3down2", "browser", "pandoc", "dot", "mmdc")},
+        }
+        with open(args.save, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2, sort_keys=True)
+
+    if regressions:
+        print(f"slower than {args.threshold}x the baseline: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
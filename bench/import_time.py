@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Measure the time of ``import k3down2`` in a fresh interpreter,
+subtracting the start up time of an interpreter that imports nothing.
+
+Usage:
+    python bench/import_time.py [-n ROUNDS]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+def spawn_time(code: str) -> float:
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], check=True)
+    return time.perf_counter() - t0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="benchmark `import k3down2`")
+    parser.add_argument("-n", type=int, default=20, help="number of rounds, default 20")
+    args = parser.parse_args()
+
+    base = []
+    imp = []
+    for _ in range(args.n):
+        base.append(spawn_time("pass"))
+        imp.append(spawn_time("import k3down2"))
+
+    base_ms = statistics.median(base) * 1000
+    imp_ms = statistics.median(imp) * 1000
+    min_ms = (min(imp) - min(base)) * 1000
+
+    print(f"interpreter start up: {base_ms:.1f} ms (median)")
+    print(f"import k3down2:       {imp_ms - base_ms:.1f} ms (median), {min_ms:.1f} ms (min)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Compare the cost per megapixel of finding the trim box of a screenshot:
+the former ``ImageChops.difference()`` implementation against ``_trim_bbox()``.
+
+Usage:
+    python bench/trim.py [-n ROUNDS]
+"""
+
+import argparse
+import time
+
+from PIL import Image, ImageChops, ImageDraw
+
+from k3down2 import down2
+
+
+def legacy_bbox(img):
+    bg = Image.new(img.mode, img.size, img.getpixel((0, 0)))
+    diff = ImageChops.difference(img, bg)
+    return diff.getbbox()
+
+
+def screenshot(size, bg):
+    # A small table-like content in a big window, as rendered with device_scale_factor=2
+    img = Image.new("RGBA", size, bg)
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((16, 16, 600, 300), fill=(242, 243, 243, 255), outline=(182, 182, 182, 255), width=2)
+    draw.text((40, 40), "k3down2 trim benchmark", fill=(0, 0, 0, 255))
+    return img
+
+
+def per_mp(fn, img, rounds):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        fn(img)
+    elapsed = (time.perf_counter() - t0) / rounds
+    return elapsed * 1000 / (img.size[0] * img.size[1] / 1e6)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="benchmark trimming screenshot borders")
+    parser.add_argument("-n", type=int, default=10, help="number of rounds, default 10")
+    args = parser.parse_args()
+
+    print(f"{'case':<28} {'legacy ms/MP':>12} {'new ms/MP':>10} {'tol=8 ms/MP':>12}")
+
+    for name, bg in (("transparent", (0, 0, 0, 0)), ("opaque", (255, 255, 255, 255))):
+        for size in ((2000, 1000), (2000, 4000)):
+            img = screenshot(size, bg)
+            legacy = per_mp(legacy_bbox, img, args.n)
+            new = per_mp(down2._trim_bbox, img, args.n)
+            tol = per_mp(lambda x: down2._trim_bbox(x, 8), img, args.n)
+
+            case = f"{name} {size[0]}x{size[1]}"
+            print(f"{case:<28} {legacy:>12.2f} {new:>10.2f} {tol:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+A content-addressed cache of conversion results, with a memory tier and an optional disk tier.
+Install it with ``set_result_cache()`` to let ``convert`` reuse the result of the same content converted before.
+"""
+
+from __future__ import annotations
+
+import collections
+import contextlib
+import os
+import tempfile
+import threading
+
+# Marks whether a cached value on disk is a str or bytes.
+_STR = b"s"
+_BYTES = b"b"
+
+
+class ResultCache:
+    """
+    A cache of conversion results, keyed by hex digests built by ``convert``
+    from the input type, the content, the output type, the options and the backend versions.
+
+    The memory tier keeps the most recently used results of this process.
+    The disk tier is shared by all processes using the same directory:
+    an entry is written to a temp file and renamed into place, thus a reader never sees a partial entry,
+    and the least recently used entries are removed when the directory grows over ``disk_size``.
+
+    It can be passed to ``RenderFarm``: every worker gets a cache of the same settings.
+
+    Args:
+        directory(str): the directory of the disk tier. Default None, i.e. memory only.
+
+        memory_size(int): max total bytes of results in memory. ``0`` disables the memory tier. Default 64 MB.
+
+        disk_size(int): max total bytes of results on disk, approximately,
+            as other processes may write at the same time. Default 1 GB.
+    """
+
+    def __init__(
+        self,
+        directory: str | os.PathLike | None = None,
+        memory_size: int = 64 << 20,
+        disk_size: int = 1 << 30,
+    ):
+        if memory_size < 0:
+            raise ValueError(f"invalid memory size: {memory_size}")
+        if disk_size < 0:
+            raise ValueError(f"invalid disk size: {disk_size}")
+
+        self.directory = None if directory is None else os.fspath(directory)
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+
+        self._lock = threading.Lock()
+        self._memory: collections.OrderedDict[str, str | bytes] = collections.OrderedDict()
+        self._memory_used = 0
+
+        # Bytes on disk at the last scan plus bytes written by this process since then.
+        self._disk_used: int | None = None
+
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+        }
+
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def __reduce__(self):
+        # Pickled for a worker process: the settings, not the entries in memory.
+        return (self.__class__, (self.directory, self.memory_size, self.disk_size))
+
+    def get(self, key: str) -> str | bytes | None:
+        """
+        Return the cached result of ``key``, or None if it is not cached.
+        A result found on disk is also put in memory.
+        """
+
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return value
+
+        value = self._disk_get(key)
+
+        with self._lock:
+            if value is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["disk_hits"] += 1
+            self._memory_put(key, value)
+        return value
+
+    def put(self, key: str, value: str | bytes) -> None:
+        """Cache a result in memory and on disk."""
+
+        with self._lock:
+            self._stats["stores"] += 1
+            self._memory_put(key, value)
+
+        self._disk_put(key, value)
+
+    def stats(self) -> dict[str, int]:
+        """
+        Return the counters of this process.
+
+        Returns:
+            dict of ``memory_hits``, ``disk_hits``, ``misses``, ``stores``,
+            ``memory_evictions``, ``disk_evictions``,
+            and ``memory_items`` and ``memory_bytes`` currently in memory.
+        """
+
+        with self._lock:
+            return {**self._stats, "memory_items": len(self._memory), "memory_bytes": self._memory_used}
+
+    def clear(self) -> None:
+        """Remove all entries, in memory and on disk."""
+
+        with self._lock:
+            self._memory.clear()
+            self._memory_used = 0
+
+        for path, _, _ in self._disk_entries():
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        self._disk_used = 0
+
+    def _memory_put(self, key: str, value: str | bytes) -> None:
+        size = len(value)
+        if size > self.memory_size:
+            return
+
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_used -= len(old)
+
+        self._memory[key] = value
+        self._memory_used += size
+
+        while self._memory_used > self.memory_size:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted)
+            self._stats["memory_evictions"] += 1
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _disk_get(self, key: str) -> str | bytes | None:
+        if self.directory is None:
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # The modification time is the last use, for eviction.
+            os.utime(path)
+        except OSError:
+            return None
+
+        typ, data = data[:1], data[1:]
+        if typ == _STR:
+            return data.decode("utf-8")
+        if typ == _BYTES:
+            return data
+        return None
+
+    def _disk_put(self, key: str, value: str | bytes) -> None:
+        if self.directory is None or self.disk_size == 0:
+            return
+
+        if isinstance(value, str):
+            data = _STR + value.encode("utf-8")
+        else:
+            data = _BYTES + value
+        if len(data) > self.disk_size:
+            return
+
+        path = self._path(key)
+        d = os.path.dirname(path)
+        try:
+            os.makedirs(d, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=d, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp)
+                raise
+        except OSError:
+            # E.g. the disk is full or another process is evicting: the cache is best effort.
+            return
+
+        with self._lock:
+            if self._disk_used is not None:
+                self._disk_used += len(data)
+            over = self._disk_used is None or self._disk_used > self.disk_size
+        if over:
+            self._evict()
+
+    def _disk_entries(self) -> list[tuple[str, int, float]]:
+        """List ``(path, size, mtime)`` of the entries on disk, skipping the temp files being written."""
+
+        if self.directory is None:
+            return []
+
+        entries = []
+        with contextlib.suppress(OSError):
+            for sub in os.scandir(self.directory):
+                if not sub.is_dir():
+                    continue
+                with contextlib.suppress(OSError):
+                    for e in os.scandir(sub.path):
+                        if e.name.startswith("."):
+                            continue
+                        with contextlib.suppress(OSError):
+                            st = e.stat()
+                            entries.append((e.path, st.st_size, st.st_mtime))
+        return entries
+
+    def _evict(self) -> None:
+        """Scan the disk tier and remove the least recently used entries until it is below 90% of ``disk_size``."""
+
+        entries = self._disk_entries()
+        used = sum(size for _, size, _ in entries)
+
+        if used > self.disk_size:
+            # Leave some room, not to scan again at the next write.
+            target = self.disk_size * 9 // 10
+            entries.sort(key=lambda e: e[2])
+            for path, size, _ in entries:
+                if used <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Removed by another process.
+                    pass
+                else:
+                    with self._lock:
+                        self._stats["disk_evictions"] += 1
+                used -= size
+
+        with self._lock:
+            self._disk_used = used
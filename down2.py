@@ -4,24 +4,37 @@
 from __future__ import annotations
 
 import atexit
+import base64
+import concurrent.futures
+import contextlib
+import contextvars
+import copy
+import functools
 import io
 import json
 import logging
+import math
 import os
 import pathlib
+import queue
 import re
 import tempfile
+import threading
+import time
 import urllib.error
 import urllib.parse
-import urllib.request
-
-from PIL import Image, ImageChops
-from playwright.sync_api import Browser, sync_playwright
-from pylatexenc.latex2text import LatexNodes2Text
+from typing import TYPE_CHECKING, BinaryIO, Callable, Iterable
 
 import k3proc
 from .mime import mime_to_suffix, mimetypes
-from .syntax_highlight import code_to_html
+
+# Heavy dependencies such as playwright, Pillow, pygments, pylatexenc and urllib.request are imported when used,
+# to keep ``import k3down2`` fast. Call ``warmup()`` to load them in advance.
+if TYPE_CHECKING:
+    from playwright.sync_api import Browser, Page
+
+    from .cache import ResultCache
+    from .pandoc_server import PandocServer
 
 
 logger = logging.getLogger(__name__)
@@ -29,26 +42,492 @@ logger = logging.getLogger(__name__)
 _playwright = None
 _browser = None
 
+# Playwright sync objects may only be used by the thread that created them.
+# Thus every browser operation is queued to and run by one render thread,
+# which lets any thread call ``render_to_img`` and ``convert``.
+_render_thread = None
+_render_queue: queue.Queue = queue.Queue()
+_render_thread_lock = threading.Lock()
+
+
+def _render_loop() -> None:
+    while True:
+        fut, fn, args, kwargs = _render_queue.get()
+        if not fut.set_running_or_notify_cancel():
+            continue
+        try:
+            fut.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            fut.set_exception(e)
+
+
+def _in_render_thread(fn, *args, **kwargs):
+    """Run ``fn`` in the render thread and return its result."""
+
+    global _render_thread
+
+    if threading.current_thread() is _render_thread:
+        return fn(*args, **kwargs)
+
+    with _render_thread_lock:
+        if _render_thread is None:
+            _render_thread = threading.Thread(target=_render_loop, name="k3down2-render", daemon=True)
+            _render_thread.start()
+            atexit.register(_in_render_thread, _shutdown_browser)
+
+    fut = concurrent.futures.Future()
+    _render_queue.put((fut, fn, args, kwargs))
+    return fut.result()
+
+
+def _get_playwright():
+    global _playwright
+    if _playwright is None:
+        from playwright.sync_api import sync_playwright
+
+        _playwright = sync_playwright().start()
+    return _playwright
+
 
 def _get_browser() -> Browser:
-    global _playwright, _browser
+    global _browser
     if _browser is None:
-        _playwright = sync_playwright().start()
-        _browser = _playwright.chromium.launch()
-        atexit.register(_shutdown_browser)
+        _browser = _get_playwright().chromium.launch()
+        _browser_stats["launches"] += 1
+        _browser_stats["renders_since_launch"] = 0
     return _browser
 
 
-def _shutdown_browser() -> None:
-    global _playwright, _browser
+def _close_browser() -> None:
+    """Close the browser and the pages of it. The next render launches a new one."""
+
+    global _browser
+    _page_pool.clear()
+    _page_documents.clear()
     if _browser is not None:
-        _browser.close()
+        try:
+            _browser.close()
+        except Exception as e:
+            logger.info("failed to close browser: %r", e)
         _browser = None
+
+
+def _shutdown_browser() -> None:
+    global _playwright
+    _close_browser()
     if _playwright is not None:
-        _playwright.stop()
+        try:
+            _playwright.stop()
+        except Exception as e:
+            logger.info("failed to stop playwright: %r", e)
         _playwright = None
 
 
+# Recycle the browser after this many renders, or when the memory of it exceeds ``max_rss`` bytes. 0 to disable.
+_browser_recycle = {"max_renders": 0, "max_rss": 0}
+
+# Reading the memory usage scans ``/proc``, thus it is checked only once per this many renders.
+_rss_check_interval = 50
+
+# Whether it is warned that the memory of the browser can not be measured for ``max_rss``.
+_rss_unknown_warned = False
+
+_browser_stats = {"launches": 0, "restarts": 0, "recycles": 0, "renders": 0, "renders_since_launch": 0}
+
+
+def set_browser_recycle(max_renders: int = 0, max_rss: int = 0) -> None:
+    """
+    Close the browser and launch a new one regularly, to release the memory a long running browser accumulates.
+
+    Args:
+        max_renders(int): recycle after this many renders. 0 to disable. Default 0.
+
+        max_rss(int): recycle when the resident memory in bytes of the browser processes exceeds it.
+            It is checked every 50 renders and requires ``/proc`` thus works only on Linux.
+            If it can not be measured, a warning is logged once and it is ignored.
+            0 to disable. Default 0.
+    """
+
+    if max_renders < 0 or max_rss < 0:
+        raise ValueError(f"invalid browser recycle limits: max_renders={max_renders} max_rss={max_rss}")
+    _browser_recycle["max_renders"] = max_renders
+    _browser_recycle["max_rss"] = max_rss
+
+
+def browser_stats() -> dict[str, int | None]:
+    """
+    Return counters of the browser backend.
+
+    Returns:
+        dict of ``launches``: browser launches; ``restarts``: relaunches because the browser died;
+        ``recycles``: relaunches because of ``set_browser_recycle()`` limits; ``renders``: total renders;
+        ``renders_since_launch``: renders by the current browser;
+        ``rss``: resident memory in bytes of the browser processes and the playwright driver,
+        or None if the browser is not running or it is unknown.
+    """
+
+    return {**_browser_stats, "rss": _browser_rss()}
+
+
+def _browser_rss() -> int | None:
+    """
+    Sum of the resident memory in bytes of the playwright driver and the browser processes it launched,
+    or None if the browser is not running or it is unknown.
+    Other child processes, such as pandoc, dot or mmdc, are not counted.
+    """
+
+    pid = _driver_pid()
+    if pid is None:
+        return None
+    return _process_tree_rss(pid)
+
+
+def _driver_pid() -> int | None:
+    """The pid of the playwright driver, which launches the browser, or None if it is not running."""
+
+    if _playwright is None:
+        return None
+    # Neither the driver nor the browser process is in the public API of playwright for python.
+    try:
+        return _playwright._impl_obj._connection._transport._proc.pid
+    except AttributeError:
+        return None
+
+
+def _process_tree_rss(root: int) -> int | None:
+    """Sum of the resident memory in bytes of process ``root`` and all its descendants, or None if it is unknown."""
+
+    try:
+        pids = [int(x) for x in os.listdir("/proc") if x.isdigit()]
+    except OSError:
+        return None
+
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    children: dict[int, list[int]] = {}
+    rss = {}
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # Fields after the command name in parentheses, which may contain spaces: state, ppid, ..., rss at index 21.
+        fields = stat[stat.rindex(")") + 2 :].split()
+        children.setdefault(int(fields[1]), []).append(pid)
+        rss[pid] = int(fields[21]) * page_size
+
+    if root not in rss:
+        return None
+
+    total = 0
+    stack = [root]
+    while stack:
+        pid = stack.pop()
+        total += rss[pid]
+        stack.extend(children.get(pid, []))
+    return total
+
+
+def _rss_exceeds(max_rss: int) -> bool:
+    global _rss_unknown_warned
+
+    rss = _browser_rss()
+    if rss is None:
+        if not _rss_unknown_warned:
+            logger.warning("can not measure the memory of the browser, max_rss of set_browser_recycle() is ignored")
+            _rss_unknown_warned = True
+        return False
+    return rss > max_rss
+
+
+def _check_browser() -> None:
+    """Relaunch the browser before rendering if it died or reached a recycle limit."""
+
+    if _browser is None:
+        return
+
+    if not _browser.is_connected():
+        logger.warning("browser disconnected, relaunch it")
+        _browser_stats["restarts"] += 1
+        _shutdown_browser()
+        return
+
+    n = _browser_stats["renders_since_launch"]
+    max_renders = _browser_recycle["max_renders"]
+    max_rss = _browser_recycle["max_rss"]
+
+    if max_renders > 0 and n >= max_renders:
+        logger.info("recycle browser after %d renders", n)
+    elif max_rss > 0 and n > 0 and n % _rss_check_interval == 0 and _rss_exceeds(max_rss):
+        logger.info("recycle browser after %d renders, rss exceeds %d", n, max_rss)
+    else:
+        return
+
+    _browser_stats["recycles"] += 1
+    _close_browser()
+
+
+def _render(fn, *args):
+    """
+    Run a render function in the render thread with a healthy browser.
+    If the browser dies during rendering, relaunch it and retry once.
+    """
+
+    _check_browser()
+    try:
+        result = fn(*args)
+    except Exception:
+        if _browser is None or _browser.is_connected():
+            raise
+        logger.warning("browser died during rendering, relaunch it and retry", exc_info=True)
+        _browser_stats["restarts"] += 1
+        _shutdown_browser()
+        result = fn(*args)
+
+    _browser_stats["renders"] += 1
+    _browser_stats["renders_since_launch"] += 1
+    return result
+
+
+# Idle pages kept for reuse by ``render_to_img``, keyed by ``(width, height, device_scale_factor)``.
+_page_pool: dict[tuple[int, int, float], list[Page]] = {}
+_page_pool_size = 8
+_page_pool_stats = {"created": 0, "reused": 0, "discarded": 0}
+
+_html_meta = r'<meta http-equiv="Content-Type" content="text/html; charset=utf-8"/>'
+
+# In-memory rendering serves the document from a never-resolving origin through request interception.
+_document_origin = "http://k3down2.invalid"
+
+# The document currently served to each page: ``path``, ``body``, ``content_type`` and ``asset_base``.
+_page_documents: dict[Page, dict] = {}
+
+
+def set_page_pool_size(size: int) -> None:
+    """
+    Set the max number of idle pages kept for reuse by ``render_to_img``.
+
+    Creating a page costs a new browser context and renderer setup, thus pages are
+    returned to a pool after rendering and reused by the next render with the same
+    viewport and scale factor.
+
+    Args:
+        size(int): max number of idle pages of all viewports. ``0`` disables pooling.
+    """
+
+    if size < 0:
+        raise ValueError(f"invalid page pool size: {size}")
+    _in_render_thread(_set_page_pool_size, size)
+
+
+def _set_page_pool_size(size: int) -> None:
+    global _page_pool_size
+    _page_pool_size = size
+
+    while _idle_page_count() > _page_pool_size:
+        key = next(k for k, pages in _page_pool.items() if pages)
+        _discard_page(_page_pool[key].pop())
+
+
+def page_pool_stats() -> dict[str, int]:
+    """
+    Return page pool counters for tuning the pool size.
+
+    Returns:
+        dict of ``size``: max idle pages; ``idle``: pages currently in the pool;
+        ``created``: pages created; ``reused``: renders served by a pooled page;
+        ``discarded``: pages closed because the pool was full or the page was broken.
+    """
+
+    # The pool is modified by the render thread only, thus read it there.
+    return _in_render_thread(_get_page_pool_stats)
+
+
+def _get_page_pool_stats() -> dict[str, int]:
+    return {"size": _page_pool_size, "idle": _idle_page_count(), **_page_pool_stats}
+
+
+def _idle_page_count() -> int:
+    return sum(len(pages) for pages in _page_pool.values())
+
+
+def _discard_page(page: Page) -> None:
+    _page_pool_stats["discarded"] += 1
+    _page_documents.pop(page, None)
+    try:
+        page.close()
+    except Exception as e:
+        logger.info("failed to close page: %r", e)
+
+
+@contextlib.contextmanager
+def _checkout_page(width: int, height: int, scale: float = 2, hook: Callable[[str, str, dict], object] | None = None):
+    """Borrow a page with the specified viewport from the pool, create one if there is no idle page."""
+
+    key = (width, height, scale)
+    with _Stage(hook, "render_to_img.page") as info:
+        idle = _page_pool.get(key)
+        info["reused"] = bool(idle)
+        if idle:
+            page = idle.pop()
+            _page_pool_stats["reused"] += 1
+        else:
+            page = _get_browser().new_page(
+                viewport={"width": width, "height": height},
+                device_scale_factor=scale,
+            )
+            doc: dict = {}
+            page.route(_document_origin + "/**", lambda route: _serve_document(doc, route))
+            _page_documents[page] = doc
+            _page_pool_stats["created"] += 1
+
+    try:
+        yield page
+    except Exception:
+        # A page in unknown state must not be reused.
+        _discard_page(page)
+        raise
+
+    _release_page(key, page)
+
+
+def _release_page(key: tuple[int, int, float], page: Page) -> None:
+    if _idle_page_count() >= _page_pool_size:
+        _discard_page(page)
+        return
+
+    # Reset the page so that the next render does not see anything from this one.
+    width, height, _ = key
+    try:
+        page.goto("about:blank")
+        if page.viewport_size != {"width": width, "height": height}:
+            page.set_viewport_size({"width": width, "height": height})
+    except Exception as e:
+        logger.info("failed to reset page, discard it: %r", e)
+        _discard_page(page)
+        return
+
+    _page_documents[page].clear()
+    _page_pool.setdefault(key, []).append(page)
+
+
+# Commands to run by ``warmup()`` to load external tools into the OS page cache.
+_tool_warmup_commands = {
+    "pandoc": ("pandoc", "--version"),
+    "dot": ("dot", "-V"),
+    "mmdc": ("npm", "exec", "--", "mmdc", "--version"),
+}
+
+
+def warmup(
+    browser: bool = True,
+    pages: int = 1,
+    width: int = 1000,
+    height: int = 2000,
+    lexers: tuple[str, ...] = (),
+    tools: tuple[str, ...] = (),
+) -> None:
+    """
+    Do the one-time setup of conversions in advance, so that the first conversion is as fast as the others.
+    E.g. call it when a service starts, before accepting requests.
+
+    Args:
+        browser(bool): launch the browser and load the image processing modules. Default True.
+
+        pages(int): number of pages to create in the page pool, for rendering with window size ``width, height``.
+            Default 1.
+
+        width(int): window width of the pages to create. Default 1000.
+
+        height(int): window height of the pages to create. Default 2000.
+
+        lexers(tuple): names of languages of code blocks to load the syntax highlighting lexer for, e.g. ``("go",)``.
+
+        tools(tuple): external tools to run once, any of ``"pandoc"``, ``"dot"`` and ``"mmdc"``.
+            With the pandoc server backend, see ``set_pandoc_backend()``, ``"pandoc"`` launches the server.
+    """
+
+    for tool in tools:
+        if tool not in _tool_warmup_commands:
+            raise ValueError(f"unknown tool to warm up: {tool}")
+
+    if browser:
+        from PIL import Image
+
+        # Load all image format plugins now instead of at the first ``Image.open()``
+        Image.init()
+        _in_render_thread(_warmup_pages, pages, width, height)
+
+    if lexers:
+        from pygments.lexers import get_lexer_by_name
+
+        for lang in lexers:
+            get_lexer_by_name(lang)
+
+    for tool in tools:
+        if tool == "pandoc" and _pandoc_server is not None:
+            from .pandoc_server import PandocServerError
+
+            try:
+                _pandoc_server.start()
+                continue
+            except PandocServerError:
+                # Logged by the server; conversions run pandoc instead.
+                pass
+        k3proc.command_ex(*_tool_warmup_commands[tool])
+
+
+def _warmup_pages(n: int, width: int, height: int) -> None:
+    _get_browser()
+    with contextlib.ExitStack() as stack:
+        # Check out all pages at the same time to create ``n`` of them, then return them to the pool on exit.
+        for _ in range(n):
+            stack.enter_context(_checkout_page(width, height))
+
+
+def _document_response(doc: dict, url: str) -> dict:
+    """
+    Build the arguments of ``Route.fulfill()`` for a request of a page loading from ``_document_origin``:
+    the document itself is served from memory and other paths from ``asset_base``.
+    """
+
+    path = urllib.parse.unquote(urllib.parse.urlsplit(url).path)
+    if path == doc.get("path"):
+        return {"body": doc["body"], "content_type": doc["content_type"]}
+
+    asset_base = doc.get("asset_base")
+    if asset_base is not None:
+        fn = os.path.join(asset_base, path.lstrip("/"))
+        if os.path.isfile(fn):
+            return {"path": fn}
+
+    return {"status": 404}
+
+
+def _serve_document(doc: dict, route) -> None:
+    route.fulfill(**_document_response(doc, route.request.url))
+
+
+def _init_document(doc: dict, mime: str, content: str | bytes, suffix: str, asset_base: str | None) -> str:
+    """Fill ``doc`` with the document to serve and return the url to load it."""
+
+    doc["path"] = "/index." + suffix
+    doc["body"] = content
+    doc["content_type"] = mime + "; charset=utf-8" if mime.startswith("text/") else mime
+    doc["asset_base"] = asset_base
+    return _document_origin + doc["path"]
+
+
+def _load_document(page: Page, mime: str, content: str | bytes, suffix: str, asset_base: str | None) -> None:
+    """
+    Navigate ``page`` to ``content`` without writing it to disk.
+    The document and the assets stay served until the page is released, for requests after loading,
+    such as lazy images or fetches by scripts.
+    """
+
+    page.goto(_init_document(_page_documents[page], mime, content, suffix, asset_base))
+
+
 zhihu_equation_url_fmt = "https://www.zhihu.com/equation?tex={texurl}{align}"
 
 zhihu_equation_fmt = (
@@ -61,19 +540,800 @@ zhihu_equation_fmt = (
 )
 
 
-def convert(input_typ: str, content: str | bytes, output_typ: str, opt: dict[str, dict] | None = None) -> str | bytes:
-    conv = mappings.get((input_typ, output_typ))
-    if conv is None:
-        raise ValueError(f"unsupported conversion: {input_typ} -> {output_typ}")
-    if callable(conv):
-        kwargs = {}
-        if opt is not None and input_typ in opt:
-            kwargs = opt[input_typ]
-        return conv(content, **kwargs)
+def convert(
+    input_typ: str,
+    content: str | bytes | os.PathLike,
+    output_typ: str,
+    opt: dict[str, dict] | None = None,
+    out: str | os.PathLike | BinaryIO | None = None,
+    hook: Callable[[str, str, dict], object] | None = None,
+) -> str | bytes | None:
+    """
+    Convert ``content`` from ``input_typ`` to ``output_typ``, following ``mappings``.
+
+    Args:
+        input_typ(str): input type such as "md", "table" or "graphviz".
+
+        content(str|PathLike): the content to convert.
+            For "md", "table", "graphviz" and "mermaid", it can be a ``pathlib.Path`` to a source file,
+            which is read by the external tool directly.
+
+        output_typ(str): output type such as "html", "png" or "jpg".
+
+        opt(dict): keyword arguments for the converter of each step, keyed by the input type of the step,
+            e.g. ``{"html": {"width": 500}}``.
+
+        out(str|PathLike|BinaryIO): a path or a writable binary stream to write the result to,
+            instead of returning it. An image is encoded straight to it; a str result is written as utf-8.
+            With a result cache, see ``set_result_cache()``, the result is built in memory to be cached.
+            Default None.
+
+        hook(callable): ``hook(event, stage, info)`` to report the timing and output size of every step
+            and of the stages in ``render_to_img``, see ``set_stage_hook()``. Default None, i.e. the hook set by
+            ``set_stage_hook()``, if any.
+
+    Returns:
+        the converted content, or None if ``out`` is specified.
+    """
+
+    return _get_plan(input_typ, output_typ, opt)(content, out=out, hook=hook)
+
+
+def _get_plan(input_typ: str, output_typ: str, opt: dict[str, dict] | None) -> ConversionPlan:
+    """Return the plan of a conversion from ``_plan_cache``, or compile one."""
+
+    key = _plan_key(input_typ, output_typ, opt)
+    if key is None:
+        return compile_plan(input_typ, output_typ, opt)
+
+    plan = _plan_cache.get(key)
+    if plan is None:
+        # Bound to a copy, for the caller to be free to modify ``opt`` afterwards.
+        plan = compile_plan(input_typ, output_typ, copy.deepcopy(opt))
+        with _plan_cache_lock:
+            while len(_plan_cache) >= _plan_cache_size:
+                del _plan_cache[next(iter(_plan_cache))]
+            _plan_cache[key] = plan
+    return plan
+
+
+def _plan_key(input_typ: str, output_typ: str, opt: dict[str, dict] | None) -> tuple[str, str, str] | None:
+    """
+    Build the key of a plan of ``convert()`` in ``_plan_cache``, or None if the plan must not be reused:
+    the options are not plain json values, such as a stream or a callable, or ``info`` to be filled for the caller.
+    """
+
+    if opt is None:
+        return input_typ, output_typ, ""
+
+    if any("info" in kwargs for kwargs in opt.values()):
+        return None
+    try:
+        return input_typ, output_typ, json.dumps(opt, sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+
+
+class Converter:
+    """
+    A direct conversion in ``mappings``, with what the router needs to know about it.
+    Register one with ``register_converter()``.
+    Calling it calls ``fn``.
+
+    Attributes:
+        input_typ(str): the type it converts from.
+
+        output_typ(str): the type it converts to.
+
+        fn(callable): ``fn(content, **kwargs)`` returns the converted content.
+
+        cost(float): estimated cost of a call, in about milliseconds. The cheapest route is chosen.
+
+        sink(bool): whether ``fn`` accepts ``out`` to write the result to a path or stream by itself.
+
+        requires(frozenset): what it depends on, such as ``"browser"``, ``"pandoc"``, ``"dot"``, ``"mmdc"``
+            or ``"network"``. A route can avoid some of them, see ``conversion_route()``.
+
+        source_only(bool): it is only used to convert the input of ``convert()``, not as a step in a longer route.
+            E.g. downloading a url as png is right only if the caller knows the url is a png.
+
+        multi_fn(callable): ``multi_fn(content, output_typs, **kwargs)`` returns a list of results of several
+            output types at once, sharing the work, such as one screenshot encoded as png and jpg.
+            Converters from the same input type share it. Used by ``convert_multi()``. None if there is no such.
+
+        version(str): the version of ``fn``, a part of the key of a cached result, see ``set_result_cache()``.
+            Change it when ``fn`` produces different results, for the cached results of the old one to be ignored.
+    """
+
+    def __init__(
+        self,
+        input_typ: str,
+        output_typ: str,
+        fn: Callable,
+        cost: float = 1,
+        sink: bool = False,
+        requires: Iterable[str] = (),
+        source_only: bool = False,
+        multi_fn: Callable | None = None,
+        version: str = "",
+    ):
+        self.input_typ = input_typ
+        self.output_typ = output_typ
+        self.fn = fn
+        self.cost = cost
+        self.sink = sink
+        self.requires = frozenset(requires)
+        self.source_only = source_only
+        self.multi_fn = multi_fn
+        self.version = version
+
+    def __call__(self, content, **kwargs):
+        return self.fn(content, **kwargs)
+
+    def __repr__(self) -> str:
+        return f"Converter({self.input_typ} -> {self.output_typ}, cost={self.cost})"
+
+
+def register_converter(
+    input_typ: str,
+    output_typ: str,
+    fn: Callable,
+    cost: float = 1,
+    sink: bool = False,
+    requires: Iterable[str] = (),
+    source_only: bool = False,
+    multi_fn: Callable | None = None,
+    version: str = "",
+) -> Converter:
+    """
+    Add a direct conversion to ``mappings``, or replace the one of the same types.
+    ``convert()`` uses it in any route it makes cheaper, e.g. a faster backend::
+
+        register_converter("md", "html", my_md_to_html, cost=5)
+
+    Args:
+        input_typ(str): the type it converts from.
+
+        output_typ(str): the type it converts to.
+
+        fn(callable): ``fn(content, **kwargs)`` returns the converted content.
+            ``kwargs`` are the options in ``opt[input_typ]`` of ``convert()``.
+
+        cost(float): estimated cost of a call, in about milliseconds. Default 1.
+
+        sink(bool): whether ``fn`` accepts ``out`` to write the result to a path or stream by itself.
+            Default False.
+
+        requires(list): what it depends on, such as ``"browser"`` or ``"pandoc"``. Default none.
+
+        source_only(bool): use it only to convert the input of ``convert()``, not as a step in a longer route.
+            Default False.
+
+        multi_fn(callable): convert to several output types at once, see ``Converter``. Default None.
+
+        version(str): the version of ``fn``, see ``Converter``. Cached results are told apart by the module,
+            the name and the code of ``fn`` too, thus it is needed only if a result changes otherwise,
+            e.g. with the data ``fn`` reads. Default "".
+
+    Returns:
+        the registered ``Converter``.
+    """
+
+    if cost < 0:
+        raise ValueError(f"invalid cost: {cost}")
+
+    conv = Converter(
+        input_typ,
+        output_typ,
+        fn,
+        cost,
+        sink=sink,
+        requires=requires,
+        source_only=source_only,
+        multi_fn=multi_fn,
+        version=version,
+    )
+    mappings[(input_typ, output_typ)] = conv
+    return conv
+
+
+def convert_multi(
+    input_typ: str,
+    content: str | bytes | os.PathLike,
+    output_typs: list[str],
+    opt: dict[str, dict] | None = None,
+    hook: Callable[[str, str, dict], object] | None = None,
+) -> dict[str, str | bytes]:
+    """
+    Convert ``content`` to several types at once, e.g. a table to html, png and jpg.
+    The routes to all the types are walked together: a result in the middle shared by several routes,
+    such as the html of a table, is built once,
+    and the images rendered by a browser from the same html are encoded from one screenshot.
+
+    Args:
+        input_typ(str): input type such as "md", "table" or "graphviz".
+
+        content(str|PathLike): the content to convert, like ``convert()``.
+
+        output_typs(list): output types such as ``["html", "png", "jpg"]``.
+
+        opt(dict): keyword arguments for the converter of each step, keyed by the input type of the step,
+            like ``convert()``. They apply to all outputs, e.g. ``{"html": {"width": 500}}``.
+
+        hook(callable): a stage hook, like ``convert()``.
+            The outputs encoded from one screenshot are reported as one ``render_to_img`` call. Default None.
+
+    Returns:
+        dict of the converted content keyed by output type.
+    """
+
+    if hook is None:
+        hook = _current_stage_hook()
+        if hook is None:
+            return _convert_multi(input_typ, content, output_typs, opt, None)
+
+    token = _stage_hook.set(hook)
+    try:
+        return _convert_multi(input_typ, content, output_typs, opt, hook)
+    finally:
+        _stage_hook.reset(token)
+
+
+def _convert_multi(
+    input_typ: str,
+    content: str | bytes | os.PathLike,
+    output_typs: list[str],
+    opt: dict[str, dict] | None,
+    hook: Callable[[str, str, dict], object] | None,
+) -> dict[str, str | bytes]:
+    plans = {typ: compile_plan(input_typ, typ, opt) for typ in output_typs}
+
+    results: dict[str, str | bytes] = {}
+
+    # Cache keys of the outputs not cached yet.
+    cache = _result_cache
+    keys = {}
+    if cache is not None:
+        for typ, plan in plans.items():
+            if plan._cacheable:
+                key = plan._cache_key(content)
+                with _Stage(hook, "convert.cache") as info:
+                    hit = cache.get(key)
+                    info["hit"] = hit is not None
+                if hit is None:
+                    keys[typ] = key
+                else:
+                    results[typ] = hit
+
+    # Results in the middle of routes, keyed by the converters that built them.
+    built: dict[tuple[Converter, ...], str | bytes | os.PathLike] = {(): content}
+
+    # Outputs built together by a ``multi_fn`` from the same result.
+    groups: dict[tuple, list[str]] = {}
+
+    for typ, plan in plans.items():
+        if typ in results:
+            continue
+
+        *convs, last = plan.converters
+        prefix = ()
+        for conv, step in zip(convs, plan._steps):
+            built_from = built[prefix]
+            prefix += (conv,)
+            if prefix not in built:
+                built[prefix] = _run_step(hook, conv, step, built_from)
+
+        full = prefix + (last,)
+        if full in built:
+            results[typ] = built[full]
+        elif last.multi_fn is not None:
+            groups.setdefault((prefix, last.input_typ, last.multi_fn), []).append(typ)
+        else:
+            results[typ] = built[full] = _run_step(hook, last, plan._steps[-1], built[prefix])
+
+    for (prefix, frm, multi_fn), typs in groups.items():
+        kwargs = (opt.get(frm) or {}) if opt is not None else {}
+        src = built[prefix]
+        stage = _Stage(
+            hook,
+            f"convert.{frm}->{','.join(typs)}",
+            input_typ=frm,
+            output_typ=typs,
+            bytes_in=None if hook is None else _size(src),
+        )
+        with stage as info:
+            outputs = multi_fn(src, typs, **kwargs)
+            if hook is not None:
+                info["bytes"] = sum(len(o) for o in outputs)
+        results.update(zip(typs, outputs))
+
+    if cache is not None:
+        for typ, key in keys.items():
+            cache.put(key, results[typ])
+
+    return {typ: results[typ] for typ in output_typs}
+
+
+class ConversionPlan:
+    """
+    A conversion from one type to another, with the route through ``mappings`` resolved
+    and the converter of every step bound to its options.
+    Calling it runs the steps one after another, without looking up ``mappings`` again.
+    Build one with ``compile_plan()``.
+
+    Attributes:
+        route(list): the types the content goes through, e.g. ``["tex_inline", "url", "svg", "png"]``.
+
+        converters(list): the ``Converter`` of every step.
+
+        cost(float): the estimated cost of the route.
+    """
+
+    def __init__(
+        self, route: list[str], converters: list[Converter], steps: list[Callable], opt: dict[str, dict] | None = None
+    ):
+        self.route = route
+        self.converters = converters
+        self.cost = sum(c.cost for c in converters)
+        self._steps = steps
+        self._sink = converters[-1].sink
+
+        # A caller passing ``info`` expects it to be filled by a real conversion.
+        self._opt = opt
+        self._cacheable = not any("info" in kwargs for kwargs in (opt or {}).values())
+        self._key_prefix: bytes | None = None
+
+    def __call__(
+        self,
+        content: str | bytes | os.PathLike,
+        out: str | os.PathLike | BinaryIO | None = None,
+        hook: Callable[[str, str, dict], object] | None = None,
+    ) -> str | bytes | None:
+        """
+        Convert ``content``, like ``convert()`` does.
+
+        Args:
+            content(str|PathLike): the content to convert.
+
+            out(str|PathLike|BinaryIO): a path or a writable binary stream to write the result to,
+                instead of returning it. Default None.
+
+            hook(callable): a stage hook, see ``set_stage_hook()``. Default None.
+
+        Returns:
+            the converted content, or None if ``out`` is specified.
+        """
+
+        if hook is None:
+            hook = _current_stage_hook()
+            if hook is None:
+                return self._call(content, out, None)
+
+        # Let ``render_to_img`` in a step find the hook.
+        token = _stage_hook.set(hook)
+        try:
+            return self._call(content, out, hook)
+        finally:
+            _stage_hook.reset(token)
+
+    def _call(
+        self,
+        content: str | bytes | os.PathLike,
+        out: str | os.PathLike | BinaryIO | None,
+        hook: Callable[[str, str, dict], object] | None,
+    ) -> str | bytes | None:
+        cache = _result_cache
+        if cache is None or not self._cacheable:
+            return self._run(content, out, hook)
+
+        key = self._cache_key(content)
+        with _Stage(hook, "convert.cache") as info:
+            result = cache.get(key)
+            info["hit"] = result is not None
+        if result is None:
+            result = self._run(content, None, hook)
+            cache.put(key, result)
+
+        if out is None:
+            return result
+        return _write_out(out, lambda f: f.write(to_bytes(result)))
+
+    def _run(
+        self,
+        content: str | bytes | os.PathLike,
+        out: str | os.PathLike | BinaryIO | None,
+        hook: Callable[[str, str, dict], object] | None = None,
+    ) -> str | bytes | None:
+        *convs, last_conv = self.converters
+        *steps, last = self._steps
+        for conv, step in zip(convs, steps):
+            content = _run_step(hook, conv, step, content)
+
+        if out is None:
+            return _run_step(hook, last_conv, last, content)
+        if self._sink:
+            return _run_step(hook, last_conv, last, content, out=out)
+        result = _run_step(hook, last_conv, last, content)
+        return _write_out(out, lambda f: f.write(to_bytes(result)))
+
+    def _cache_key(self, content: str | bytes | os.PathLike) -> str:
+        """Build the key of a result: the route, the options, the backend versions and the content."""
+
+        if self._key_prefix is None:
+            versions = {}
+            for conv in self.converters:
+                for backend in sorted(conv.requires):
+                    versions[backend] = _backend_version(backend)
+            versions["k3down2"] = _backend_version("k3down2")
+
+            # A converter replaced by ``register_converter()`` must not hit the results of the old one.
+            fns = [[_fn_identity(conv.fn), conv.version] for conv in self.converters]
+
+            # ``repr`` of an option not in json is not always stable, which makes only a miss.
+            meta = json.dumps([self.route, fns, self._opt, versions], sort_keys=True, default=repr)
+            self._key_prefix = meta.encode("utf-8") + b"\0"
+
+        import hashlib
+
+        h = hashlib.sha256(self._key_prefix)
+        if isinstance(content, os.PathLike):
+            with open(content, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+        else:
+            h.update(to_bytes(content))
+        return h.hexdigest()
+
+    def __repr__(self) -> str:
+        return f"ConversionPlan({' -> '.join(self.route)}, cost={self.cost})"
+
+
+def _fn_identity(fn: Callable) -> str:
+    """
+    Identify a converter function across processes, by its module, name and code,
+    which tells apart two lambdas defined at the same place, or an edited function.
+    """
+
+    import hashlib
+
+    if isinstance(fn, functools.partial):
+        return f"partial({_fn_identity(fn.func)}, {fn.args!r}, {sorted(fn.keywords.items())!r})"
+
+    name = f"{getattr(fn, '__module__', '')}.{getattr(fn, '__qualname__', type(fn).__qualname__)}"
+    code = getattr(fn, "__code__", None)
+    if code is None:
+        return name
+
+    h = hashlib.sha256()
+    _hash_code(h, code)
+    h.update(repr(getattr(fn, "__defaults__", None)).encode("utf-8"))
+    return f"{name}:{h.hexdigest()[:16]}"
+
+
+def _hash_code(h, code) -> None:
+    # The ``repr`` of a nested code object has its address, thus it is hashed by its content.
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode("utf-8"))
+    for const in code.co_consts:
+        if hasattr(const, "co_code"):
+            _hash_code(h, const)
+        else:
+            h.update(repr(const).encode("utf-8"))
+
+
+# The cache of conversion results used by ``convert()``, see ``set_result_cache()``.
+_result_cache: ResultCache | None = None
+
+# Versions of the backends a result depends on, looked up once.
+_backend_versions: dict[str, str] = {}
+
+
+def set_result_cache(cache: ResultCache | None) -> None:
+    """
+    Let ``convert()`` and compiled plans reuse results of the same conversions, e.g. for articles re-published
+    with the same tables, formulas and diagrams::
+
+        set_result_cache(ResultCache("~/.cache/k3down2"))
+
+    A result is keyed by the types, the converters, the content, the options and the versions of k3down2
+    and the backends, such as pandoc or the browser.
+    A converter is identified by the module, the name and the code of its function, and its ``version``,
+    thus a result of a converter replaced by ``register_converter()`` is not reused.
+    A conversion with an ``info`` option is not cached.
+
+    Args:
+        cache(ResultCache): the cache to use, or None to disable caching.
+    """
+
+    global _result_cache
+    _result_cache = cache
+
+
+def _backend_version(backend: str) -> str:
+    """Return the version of a backend, e.g. ``pandoc`` or ``browser``, or "" if it can not be told."""
+
+    version = _backend_versions.get(backend)
+    if version is not None:
+        return version
+
+    version = ""
+    try:
+        if backend == "k3down2" or backend == "browser":
+            from importlib.metadata import version as pkg_version
+
+            version = pkg_version("k3down2" if backend == "k3down2" else "playwright")
+        elif backend in _tool_warmup_commands:
+            _, out, err = k3proc.command_ex(*_tool_warmup_commands[backend])
+            # dot prints its version to stderr.
+            version = (out or err).strip().split("\n")[0]
+    except Exception as e:
+        logger.info("failed to get version of %s: %r", backend, e)
+
+    _backend_versions[backend] = version
+    return version
+
+
+# The stage hook of every conversion, see ``set_stage_hook()``.
+_default_stage_hook: Callable[[str, str, dict], object] | None = None
+
+# The stage hook of the conversion running in the current context,
+# through which ``convert`` passes its hook to the ``render_to_img`` of a step.
+_stage_hook: contextvars.ContextVar[Callable[[str, str, dict], object] | None] = contextvars.ContextVar(
+    "k3down2_stage_hook", default=None
+)
+
+
+def set_stage_hook(hook: Callable[[str, str, dict], object] | None) -> None:
+    """
+    Report the stages of every ``convert()`` and ``render_to_img()`` to ``hook``,
+    unless another hook is passed to the call. E.g. to export timings to a metrics system::
+
+        def hook(event, stage, info):
+            if event == "end":
+                metrics.observe(stage, info["duration"])
+
+        set_stage_hook(hook)
+
+    ``hook(event, stage, info)`` is called with ``event`` "start" and then "end" for every stage:
+
+    - ``convert.<input_typ>-><output_typ>``: a step of a conversion route, e.g. ``convert.md->html``.
+      ``info`` has ``input_typ``, ``output_typ`` and ``bytes_in``.
+      Images encoded from one screenshot by ``convert_multi()`` are one step, e.g. ``convert.html->png,jpg``.
+    - ``convert.cache``: a lookup in the result cache, ``info`` has ``hit``.
+    - ``render_to_img.measure``: laying out the content to measure its width for ``target_width``.
+    - ``render_to_img.render``: the browser work, including waiting for the render thread,
+      made of ``render_to_img.page``, checking out a page from the pool, ``info`` has ``reused``,
+      ``render_to_img.write_file`` with ``via_file``,
+      ``render_to_img.goto``, loading the content,
+      ``render_to_img.layout``, measuring the content box or the content height,
+      and ``render_to_img.screenshot``.
+    - ``render_to_img.trim``: decoding the screenshot, trimming and resizing it.
+    - ``render_to_img.encode``: encoding an output image, ``info`` has ``type``.
+
+    At "end", ``info`` also has ``duration`` in seconds, ``bytes`` of the output if it is known,
+    and ``error``, the exception, if the stage failed.
+    The same ``info`` dict is passed at "start" and "end" of a stage.
+    Browser stages are reported from the render thread.
+    An exception raised by the hook is logged and ignored.
+
+    Without a hook, a stage costs a few attribute lookups.
+
+    Args:
+        hook(callable): the hook, or None to disable it.
+    """
+
+    global _default_stage_hook
+    _default_stage_hook = hook
+
+
+def _current_stage_hook() -> Callable[[str, str, dict], object] | None:
+    hook = _stage_hook.get()
+    if hook is None:
+        return _default_stage_hook
+    return hook
+
+
+class _Stage:
+    """
+    A context manager reporting a stage to a hook, see ``set_stage_hook()``.
+    It does nothing if ``hook`` is None.
+    Entering it returns ``info``, to which the stage may add ``bytes`` of its output.
+    """
+
+    __slots__ = ("hook", "stage", "info", "t0")
+
+    def __init__(self, hook: Callable[[str, str, dict], object] | None, stage: str, **info):
+        self.hook = hook
+        self.stage = stage
+        self.info = info
+
+    def __enter__(self) -> dict:
+        if self.hook is not None:
+            self._emit("start")
+            self.t0 = time.perf_counter()
+        return self.info
+
+    def __exit__(self, typ, exc, tb) -> None:
+        if self.hook is not None:
+            self.info["duration"] = time.perf_counter() - self.t0
+            if exc is not None:
+                self.info["error"] = exc
+            self._emit("end")
+
+    def _emit(self, event: str) -> None:
+        try:
+            self.hook(event, self.stage, self.info)
+        except Exception:
+            logger.exception("stage hook failed at %s of %s", event, self.stage)
+
+
+def _size(content: str | bytes | os.PathLike | None) -> int | None:
+    """Return the size in bytes of a result, or of the file at a path, or None if it is not known."""
+
+    if isinstance(content, bytes):
+        return len(content)
+    if isinstance(content, str):
+        return len(content.encode("utf-8"))
+    if isinstance(content, os.PathLike):
+        try:
+            return os.path.getsize(content)
+        except OSError:
+            return None
+    return None
+
+
+def _run_step(
+    hook: Callable[[str, str, dict], object] | None, conv: Converter, step: Callable, content, **kwargs
+) -> str | bytes | None:
+    """Run a step of a conversion route, reported to ``hook``."""
+
+    if hook is None:
+        return step(content, **kwargs)
+
+    with _step_stage(hook, conv, content) as info:
+        result = step(content, **kwargs)
+        size = _size(result)
+        if size is not None:
+            info["bytes"] = size
+    return result
+
+
+def _step_stage(hook: Callable[[str, str, dict], object], conv: Converter, content) -> _Stage:
+    return _Stage(
+        hook,
+        f"convert.{conv.input_typ}->{conv.output_typ}",
+        input_typ=conv.input_typ,
+        output_typ=conv.output_typ,
+        bytes_in=_size(content),
+    )
+
+
+# The cheapest routes through ``mappings``, keyed by ``(input_typ, output_typ, avoid)``.
+_route_cache: dict[tuple[str, str, frozenset], list[Converter]] = {}
+
+# Plans used by ``convert()``, keyed by ``(input_typ, output_typ, opt in json)``, the oldest is dropped when it is full.
+_plan_cache: dict[tuple[str, str, str], ConversionPlan] = {}
+_plan_cache_size = 256
+_plan_cache_lock = threading.Lock()
+
+
+def conversion_route(input_typ: str, output_typ: str, avoid: Iterable[str] = ()) -> list[Converter]:
+    """
+    Find the route ``convert()`` takes: the cheapest chain of converters in ``mappings``
+    from ``input_typ`` to ``output_typ``, by the sum of their ``cost``.
+    A legacy indirect entry in ``mappings``, e.g. ``mappings[("md", "png")] = "html"``, pins the route through it.
+
+    Args:
+        input_typ(str): input type such as "md", "table" or "tex_inline".
+
+        output_typ(str): output type such as "html", "png" or "jpg".
+
+        avoid(list): skip converters requiring any of these, e.g. ``["browser"]``. Default none.
+
+    Returns:
+        list of ``Converter``.
+
+    Raises:
+        ValueError: if there is no route.
+    """
+
+    return _resolve_route(input_typ, output_typ, frozenset(avoid))
+
+
+def _resolve_route(input_typ: str, output_typ: str, avoid: frozenset, pinned: set | None = None) -> list[Converter]:
+    key = (input_typ, output_typ, avoid)
+    route = _route_cache.get(key)
+    if route is not None:
+        return route
+
+    via = mappings.get((input_typ, output_typ))
+    if isinstance(via, str):
+        pinned = set() if pinned is None else pinned
+        if (input_typ, output_typ) in pinned:
+            raise ValueError(f"conversion loop in mappings: {input_typ} -> {output_typ} via {via}")
+        pinned.add((input_typ, output_typ))
+        route = _resolve_route(input_typ, via, avoid, pinned) + _resolve_route(via, output_typ, avoid, pinned)
     else:
-        #  indirect convertion
-        inp = convert(input_typ, content, conv, opt=opt)
-        return convert(conv, inp, output_typ, opt=opt)
+        route = _cheapest_route(input_typ, output_typ, avoid)
+        if route is None:
+            raise ValueError(f"unsupported conversion: {input_typ} -> {output_typ}")
+
+    _route_cache[key] = route
+    return route
+
+
+def _cheapest_route(input_typ: str, output_typ: str, avoid: frozenset) -> list[Converter] | None:
+    """Dijkstra's shortest path over the converters in ``mappings``."""
+
+    import heapq
+
+    edges: dict[str, list[Converter]] = {}
+    for conv in mappings.values():
+        if isinstance(conv, Converter) and not conv.requires & avoid:
+            edges.setdefault(conv.input_typ, []).append(conv)
+
+    # Ties are broken by fewer steps, then by the order found, to be deterministic.
+    seq = 0
+    heap: list = [(0, 0, seq, input_typ, [])]
+    done = set()
+    while heap:
+        cost, steps, _, typ, route = heapq.heappop(heap)
+        if typ == output_typ and route:
+            return route
+        if typ in done:
+            continue
+        done.add(typ)
+
+        for conv in edges.get(typ, ()):
+            if conv.source_only and typ != input_typ:
+                continue
+            if conv.output_typ in done:
+                continue
+            seq += 1
+            heapq.heappush(heap, (cost + conv.cost, steps + 1, seq, conv.output_typ, route + [conv]))
+
+    return None
+
+
+def compile_plan(
+    input_typ: str, output_typ: str, opt: dict[str, dict] | None = None, avoid: Iterable[str] = ()
+) -> ConversionPlan:
+    """
+    Resolve the route of a conversion once and return a callable that converts content along it,
+    for converting many contents of the same types, e.g. all the formulas in a book::
+
+        plan = compile_plan("tex_inline", "png")
+        imgs = [plan(tex) for tex in formulas]
+
+    ``convert()`` keeps such plans internally.
+    A plan does not see changes to ``mappings`` after it is compiled.
+
+    Args:
+        input_typ(str): input type such as "md", "table" or "tex_inline".
+
+        output_typ(str): output type such as "html", "png" or "jpg".
+
+        opt(dict): keyword arguments for the converter of each step, keyed by the input type of the step,
+            like ``convert()``.
+
+        avoid(list): skip converters requiring any of these, see ``conversion_route()``. Default none.
+
+    Returns:
+        ConversionPlan
+    """
+
+    route = conversion_route(input_typ, output_typ, avoid)
+
+    steps = []
+    for conv in route:
+        fn = conv.fn
+        kwargs = opt.get(conv.input_typ) if opt is not None else None
+        if kwargs:
+            fn = functools.partial(fn, **kwargs)
+        steps.append(fn)
+
+    types = [input_typ] + [conv.output_typ for conv in route]
+    return ConversionPlan(types, route, steps, opt)
 
 
 def tex_to_zhihu_compatible(tex: str) -> tuple[str, str]:
@@ -263,101 +1523,920 @@ def tex_to_plain(tex: str) -> str:
 
         tex = "".join(pieces)
 
-    return LatexNodes2Text().latex_to_text(tex)
+    from pylatexenc.latex2text import LatexNodes2Text
+
+    return LatexNodes2Text().latex_to_text(tex)
+
+
+def tex_to_img(tex: str, block: bool, typ: str) -> str | bytes:
+    """
+    Convert tex source to an image.
+
+    Args:
+        tex(str): tex source
+
+        block(bool): whether to render a block(center-aligned) equation or
+            inline equation.
+
+        typ(str): output image type such as "png", "jpg", "webp" or "avif"
+
+    Returns:
+        bytes of png data.
+    """
+
+    input_type = "tex_block"
+    if not block:
+        input_type = "tex_inline"
+    return convert(input_type, tex, typ)
+
+
+def download(url: str, out: str | os.PathLike | BinaryIO | None = None) -> bytes | None:
+    """
+    Download content from ``url`` and return the responded data.
+
+    Args:
+        url(str): the url from which to download.
+
+        out(str|PathLike|BinaryIO): a path or a writable binary stream to copy the response to,
+            without holding all of it in memory. Default None.
+
+    Returns:
+        bytes of downloaded data, or None if ``out`` is specified.
+    """
+
+    import shutil
+    import urllib.request
+
+    with urllib.request.urlopen(url, timeout=30) as resp:
+        if out is None:
+            return resp.read()
+        return _write_out(out, lambda f: shutil.copyfileobj(resp, f))
+
+
+def web_to_img(pagefn: str, typ: str) -> bytes:
+    """
+    Render a web page, which could be html, svg etc into image.
+
+    Args:
+        pagefn(string): path to a local file that can be rendered in a browser.
+
+        typ(string): specify output image type such as "png", "jpg"
+
+    Returns:
+        bytes of the image data
+    """
+
+    intyp = pagefn.rsplit(".")[-1]
+    page = fread(pagefn)
+    return render_to_img(intyp, page, typ)
+
+
+def _trim_bbox(img, tolerance: int = 0) -> tuple[int, int, int, int] | None:
+    """
+    Find the box of the content in an image, excluding the borders of the top-left pixel color,
+    like ImageMagick ``-trim``.
+    A pixel is content if any channel differs from the border color by more than ``tolerance``.
+
+    Returns:
+        the box ``(left, upper, right, lower)``, or None if the image has only the border color.
+    """
+
+    from PIL import Image, ImageChops
+
+    bg = img.getpixel((0, 0))
+    if img.mode in ("RGBA", "LA") and bg[-1] <= tolerance:
+        # A transparent border, e.g. a screenshot omitting background: the alpha channel tells what is painted.
+        # It scans one band instead of building two more full images.
+        band = img.getchannel("A")
+    else:
+        band = ImageChops.difference(img, Image.new(img.mode, img.size, bg))
+
+    if tolerance > 0:
+        band = band.point(lambda v: 255 if v > tolerance else 0)
+    return band.getbbox(alpha_only=False)
+
+
+# Named png output profiles, see ``render_to_img()``.
+png_profiles: dict[str, dict] = {
+    # Pillow defaults.
+    "default": {},
+    # Encode quickly at the cost of a bigger file.
+    "fast": {"compress_level": 1},
+    # The smallest file: a palette of at most 256 colors, which is hardly visible for flat-color images
+    # such as tables and code, maximum compression, and no metadata.
+    "small": {"colors": 256, "optimize": True, "strip": True},
+}
+
+_png_profile_options = ("compress_level", "optimize", "colors", "strip")
+
+
+def _png_options(png_profile: str | dict | None) -> dict:
+    """Resolve a png profile name or a dict of options to a dict of options."""
+
+    if png_profile is None:
+        return {}
+
+    if isinstance(png_profile, str):
+        if png_profile not in png_profiles:
+            raise ValueError(f"unknown png profile: {png_profile!r}, expect one of {sorted(png_profiles)}")
+        return png_profiles[png_profile]
+
+    unknown = set(png_profile) - set(_png_profile_options)
+    if unknown:
+        raise ValueError(f"unknown png profile options: {sorted(unknown)}, expect some of {_png_profile_options}")
+
+    colors = png_profile.get("colors")
+    if colors is not None and not 2 <= colors <= 256:
+        raise ValueError(f"invalid png profile colors: {colors}, expect 2 to 256")
+
+    level = png_profile.get("compress_level")
+    if level is not None and not 0 <= level <= 9:
+        raise ValueError(f"invalid png profile compress_level: {level}, expect 0 to 9")
+
+    return png_profile
+
+
+def _save_png(img, buf: io.BytesIO, options: dict) -> None:
+    """Save an image as png with the options of a png profile."""
+
+    from PIL import Image
+
+    colors = options.get("colors")
+    if colors is not None and img.mode != "P":
+        # Dithering adds noise to flat colors, which compresses worse and looks no better.
+        img = img.quantize(colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+
+    kwargs = {}
+    if "compress_level" in options:
+        kwargs["compress_level"] = options["compress_level"]
+    if options.get("optimize"):
+        kwargs["optimize"] = True
+    if options.get("strip"):
+        # Pillow copies the color profile of the source image unless it is overridden.
+        kwargs["icc_profile"] = None
+
+    img.save(buf, format="PNG", **kwargs)
+
+
+def _check_image_type(typ: str) -> None:
+    """Raise ValueError if Pillow can not encode images of type ``typ``."""
+
+    if typ == "avif":
+        from PIL import features
+
+        if not features.check("avif"):
+            raise ValueError("avif output requires Pillow built with libavif")
+
+
+# The lowest quality tried to fit a jpg into a byte budget, before downscaling or giving up.
+_jpeg_min_quality = 10
+
+# The max number of times a jpg is downscaled to fit into a byte budget.
+_jpeg_max_downscales = 8
+
+
+def _save_jpeg_within(img, quality: int, max_bytes: int, downscale: bool, info: dict | None) -> bytes:
+    """
+    Encode an RGB image as jpg of at most ``max_bytes`` bytes, at the highest quality not above ``quality``.
+    The size of a jpg grows with the quality, thus the quality is binary searched,
+    which takes about 7 encodings in the worst case and one if ``quality`` already fits.
+    If it does not fit at ``_jpeg_min_quality`` and ``downscale`` is True,
+    the image is shrunk by the estimated ratio and searched again.
+
+    If ``info`` is specified, the chosen ``quality`` and the final ``width`` and ``height`` are stored in it.
+    """
+
+    from PIL import Image
+
+    def encode(img, q: int) -> bytes:
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=q)
+        return buf.getvalue()
+
+    for _ in range(_jpeg_max_downscales + 1):
+        data = encode(img, quality)
+        chosen = quality
+
+        if len(data) > max_bytes:
+            # The size at the lowest quality tried.
+            smallest = len(data)
+            data, chosen = None, None
+
+            lo, hi = _jpeg_min_quality, quality - 1
+            while lo <= hi:
+                q = (lo + hi) // 2
+                d = encode(img, q)
+                if len(d) <= max_bytes:
+                    data, chosen = d, q
+                    lo = q + 1
+                else:
+                    smallest = len(d)
+                    hi = q - 1
+
+        if data is not None:
+            if info is not None:
+                info["quality"] = chosen
+                info["width"], info["height"] = img.size
+            return data
+
+        if not downscale or img.width <= 1 or img.height <= 1:
+            break
+
+        # Bytes scale roughly with the pixel count; aim a little under the budget.
+        ratio = min(math.sqrt(max_bytes / smallest) * 0.9, 0.9)
+        size = (max(int(img.width * ratio), 1), max(int(img.height * ratio), 1))
+        img = img.resize(size, Image.Resampling.LANCZOS)
+
+    raise ValueError(f"can not encode jpg within {max_bytes} bytes")
+
+
+def _save_image(
+    img,
+    buf: BinaryIO,
+    typ: str,
+    quality: int = 75,
+    lossless: bool = False,
+    png_profile: str | dict | None = None,
+    max_bytes: int | None = None,
+    downscale: bool = False,
+    info: dict | None = None,
+) -> None:
+    """
+    Encode an image as ``typ``: "png", "webp", "avif" or "jpg", and write it to the binary stream ``buf``.
+    A jpg is flattened onto a white background, the other types keep the transparency.
+    A jpg is fit into ``max_bytes`` if it is specified, see ``_save_jpeg_within()``.
+    """
+
+    from PIL import Image
+
+    if typ == "png":
+        _save_png(img, buf, _png_options(png_profile))
+    elif typ == "webp":
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+        img.save(buf, format="WEBP", quality=quality, lossless=lossless)
+    elif typ == "avif":
+        _check_image_type(typ)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+        if lossless:
+            # The encoder has no lossless mode: keep full chroma at the highest quality, off by at most 1 per channel.
+            img.save(buf, format="AVIF", quality=100, subsampling="4:4:4")
+        else:
+            img.save(buf, format="AVIF", quality=quality)
+    else:
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        if img.mode == "RGBA":
+            background.paste(img, mask=img.split()[3])
+        else:
+            background.paste(img)
+        if max_bytes is not None:
+            buf.write(_save_jpeg_within(background, quality, max_bytes, downscale, info))
+        else:
+            background.save(buf, format="JPEG", quality=quality)
+
+
+def _trim(
+    png_data: bytes, trim: bool = True, tolerance: int = 0, target_width: int | None = None, info: dict | None = None
+):
+    """
+    Decode a screenshot, trim whitespace borders and resize it to ``target_width`` if it is specified.
+    If ``info`` is specified, the size of the image is stored in it.
+
+    Returns:
+        the PIL image.
+    """
+
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(png_data))
+
+    if trim:
+        bbox = _trim_bbox(img, tolerance)
+        if bbox:
+            img = img.crop(bbox)
+
+    if target_width is not None and img.width != target_width:
+        h = max(round(img.height * target_width / img.width), 1)
+        img = img.resize((target_width, h), Image.Resampling.LANCZOS)
+
+    if info is not None:
+        info["width"], info["height"] = img.size
+
+    return img
+
+
+def _trim_and_convert(
+    png_data: bytes,
+    typ: str,
+    trim: bool = True,
+    tolerance: int = 0,
+    quality: int = 75,
+    lossless: bool = False,
+    png_profile: str | dict | None = None,
+    target_width: int | None = None,
+    max_bytes: int | None = None,
+    downscale: bool = False,
+    info: dict | None = None,
+    out: str | os.PathLike | BinaryIO | None = None,
+) -> bytes | None:
+    """
+    Trim whitespace borders from a screenshot and convert to the target format.
+    If ``target_width`` is specified, the trimmed image is resized to that width, keeping the aspect ratio.
+    If ``info`` is specified, the size of the output image is stored in it.
+    If ``out`` is specified, the image is written to it and None is returned, see ``_write_out()``.
+    """
+    img = _trim(png_data, trim=trim, tolerance=tolerance, target_width=target_width, info=info)
+
+    return _write_out(
+        out,
+        lambda f: _save_image(
+            img,
+            f,
+            typ,
+            quality=quality,
+            lossless=lossless,
+            png_profile=png_profile,
+            max_bytes=max_bytes,
+            downscale=downscale,
+            info=info,
+        ),
+    )
+
+
+def render_to_img(
+    mime: str,
+    content: str | bytes,
+    typ: str,
+    width: int = 1000,
+    height: int = 2000,
+    asset_base: str | None = None,
+    via_file: bool = False,
+    clip: bool = False,
+    full_page: bool = False,
+    trim_tolerance: int = 0,
+    quality: int = 75,
+    lossless: bool = False,
+    png_profile: str | dict | None = None,
+    scale: float = 2,
+    target_width: int | None = None,
+    max_bytes: int | None = None,
+    downscale: bool = False,
+    info: dict | None = None,
+    out: str | os.PathLike | BinaryIO | None = None,
+    hook: Callable[[str, str, dict], object] | None = None,
+) -> bytes | None:
+    """
+    Render content that is renderable in a browser to image.
+    Such as html, svg etc into image.
+    Uses Playwright (Chromium) for rendering and Pillow for image processing.
+    Pages are reused across calls, see ``set_page_pool_size()``.
+    It is safe to call from any thread: browser work is run by an internal render thread,
+    while the image processing runs in the calling thread.
+
+    Args:
+        mime(str): a full mime type such as ``image/jpeg`` or a shortcut ``jpg``.
+
+        content(str): content to render, such as jpeg data or svg source.
+
+        typ(string): specifies output image type: "png", "jpg", "webp" or "avif".
+            avif requires Pillow built with libavif.
+
+        width(int): specifies the window width to render a page. Default 1000.
+
+        height(int): specifies the window height to render a page. Default 2000.
+
+        asset_base(str): specifies the path to assets dir. E.g. the image base path in a html page.
+
+        via_file(bool): write content to a temp file and load it with a ``file://`` url,
+            instead of serving it from memory.
+            Required only if the content refers to absolute ``file://`` urls. Default False.
+
+        clip(bool): measure the bounding box of the painted content in the page and capture only that area,
+            instead of capturing the whole page and trimming the borders from the image.
+            It is much cheaper for a small content in a big window.
+            The painted content is text, images and elements with a background or border.
+            If there is no such content, it falls back to trimming.
+            For ``typ="jpg"``, the browser encodes the jpeg on a white background directly,
+            without decoding and re-encoding a png. Default False.
+
+        full_page(bool): capture content taller than the window in one pass,
+            instead of resizing the window to the content height, which lays out and paints the page twice.
+            Default False.
+
+        trim_tolerance(int): when trimming the borders, treat a pixel as border if none of its channels differs
+            from the border color by more than this value, e.g. to trim anti-aliased edges. Default 0.
+
+        quality(int): jpg, lossy webp or lossy avif quality from 0 to 100. Default 75.
+
+        lossless(bool): encode webp losslessly, or avif nearly losslessly. Default False.
+
+        png_profile(str|dict): how to encode a png. A name in ``png_profiles``:
+
+            - ``"default"``: Pillow defaults.
+            - ``"fast"``: the fastest encoding, for a bigger file.
+            - ``"small"``: the smallest file, by quantising to a palette of 256 colors,
+              maximum compression and stripping metadata.
+
+            Or a dict of options:
+
+            - ``compress_level``(int): zlib level from 0 to 9.
+            - ``optimize``(bool): search for the best compression, slow.
+            - ``colors``(int): quantise to a palette of at most this many colors, from 2 to 256. It is lossy.
+            - ``strip``(bool): drop metadata such as the color profile.
+
+            With ``convert``, pass it as ``opt={"html": {"png_profile": "small"}}``. Default None, i.e. Pillow defaults.
+
+        scale(float): device scale factor, i.e. image pixels per CSS pixel.
+            E.g. ``1`` renders a quarter of the pixels of the default ``2``. Default 2.
+
+        target_width(int): the width in pixels of the output image.
+            The content is laid out once more at scale 1 to measure its width,
+            then rendered at the smallest scale that reaches ``target_width`` and resized to it.
+            ``scale`` is ignored. Default None.
+
+        max_bytes(int): for jpg, the max size of the output in bytes, e.g. the upload limit of a site.
+            The highest quality not above ``quality`` that fits is searched for.
+            ``ValueError`` is raised if it does not fit at the lowest quality and ``downscale`` is False.
+            Default None.
+
+        downscale(bool): with ``max_bytes``, shrink the image if it does not fit at the lowest quality.
+            Default False.
+
+        info(dict): if specified, it is filled with ``width`` and ``height`` in pixels of the output image,
+            and ``scale``, the device scale factor it is rendered at.
+            With ``max_bytes``, it also has ``quality``, the chosen jpg quality.
+
+        out(str|PathLike|BinaryIO): a path or a writable binary stream to write the image to,
+            instead of returning it. A file at the path is replaced only when the image is complete.
+            Default None.
+
+        hook(callable): ``hook(event, stage, info)`` to report the timing of the stages such as loading,
+            screenshot and encoding, see ``set_stage_hook()``.
+            Default None, i.e. the hook of the ``convert`` calling it, or the hook set by ``set_stage_hook()``.
+
+    Returns:
+        bytes of the image data, or None if ``out`` is specified.
+    """
+
+    return _render_to_imgs(
+        mime,
+        content,
+        [typ],
+        width=width,
+        height=height,
+        asset_base=asset_base,
+        via_file=via_file,
+        clip=clip,
+        full_page=full_page,
+        trim_tolerance=trim_tolerance,
+        quality=quality,
+        lossless=lossless,
+        png_profile=png_profile,
+        scale=scale,
+        target_width=target_width,
+        max_bytes=max_bytes,
+        downscale=downscale,
+        info=info,
+        outs=[out],
+        hook=hook,
+    )[0]
+
+
+def _render_to_imgs(
+    mime: str,
+    content: str | bytes,
+    typs: list[str],
+    width: int = 1000,
+    height: int = 2000,
+    asset_base: str | None = None,
+    via_file: bool = False,
+    clip: bool = False,
+    full_page: bool = False,
+    trim_tolerance: int = 0,
+    quality: int = 75,
+    lossless: bool = False,
+    png_profile: str | dict | None = None,
+    scale: float = 2,
+    target_width: int | None = None,
+    max_bytes: int | None = None,
+    downscale: bool = False,
+    info: dict | None = None,
+    outs: list[str | os.PathLike | BinaryIO | None] | None = None,
+    hook: Callable[[str, str, dict], object] | None = None,
+) -> list[bytes | None]:
+    """
+    Render content once and encode it as every type in ``typs``, see ``render_to_img()`` for the arguments.
+    ``max_bytes`` applies to the jpg output.
+
+    Returns:
+        list of the image data of every type, or None for a type whose ``outs`` item is specified.
+    """
+
+    if hook is None:
+        hook = _current_stage_hook()
+
+    m, content, suffix = _prepare_content(mime, content, asset_base, via_file)
+    png_options = _check_render_options(typs, scale, target_width, max_bytes, png_profile)
+
+    if target_width is not None:
+        with _Stage(hook, "render_to_img.measure"):
+            content_width = _in_render_thread(
+                _render, _content_width, m, content, suffix, width, height, asset_base, via_file, hook
+            )
+        scale = _scale_for_width(target_width, content_width)
+
+    if info is not None:
+        info["scale"] = scale
+
+    jpeg_quality = _browser_jpeg_quality(typs, quality, target_width, max_bytes)
+    with _Stage(hook, "render_to_img.render") as stage_info:
+        data, box = _in_render_thread(
+            _render,
+            _screenshot,
+            m,
+            content,
+            suffix,
+            width,
+            height,
+            asset_base,
+            via_file,
+            clip,
+            full_page,
+            jpeg_quality,
+            scale,
+            hook,
+        )
+        stage_info["bytes"] = len(data)
+
+    return _encode_screenshot(
+        data,
+        box,
+        typs,
+        jpeg_quality=jpeg_quality,
+        trim_tolerance=trim_tolerance,
+        quality=quality,
+        lossless=lossless,
+        png_options=png_options,
+        target_width=target_width,
+        max_bytes=max_bytes,
+        downscale=downscale,
+        info=info,
+        outs=outs,
+        hook=hook,
+    )
+
+
+def _prepare_content(
+    mime: str, content: str | bytes, asset_base: str | None, via_file: bool
+) -> tuple[str, str | bytes, str]:
+    """
+    Add the page settings to html content and resolve the mime type.
+
+    Returns:
+        the full mime type, the content to load and the file suffix of it.
+    """
+
+    if "html" in mime:
+        content = _html_meta + content
+
+        if via_file and asset_base is not None:
+            base_uri = pathlib.Path(asset_base).as_uri()
+            content = '<base href="{}/">'.format(base_uri) + content
+
+    m = mimetypes.get(mime) or mime
+    suffix = mime_to_suffix.get(m, mime)
+    return m, content, suffix
 
 
-def tex_to_img(tex: str, block: bool, typ: str) -> str | bytes:
+def _check_render_options(
+    typs: list[str], scale: float, target_width: int | None, max_bytes: int | None, png_profile: str | dict | None
+) -> dict:
     """
-    Convert tex source to an image.
-
-    Args:
-        tex(str): tex source
+    Raise ``ValueError`` if a render option is invalid, see ``render_to_img()``.
 
-        block(bool): whether to render a block(center-aligned) equation or
-            inline equation.
+    Returns:
+        the png encoding options.
+    """
 
-        typ(str): output image type such as "png" or "jpg"
+    png_options = _png_options(png_profile)
+    for typ in typs:
+        _check_image_type(typ)
+
+    if target_width is not None:
+        if target_width < 1:
+            raise ValueError(f"invalid target width: {target_width}")
+    elif scale <= 0:
+        raise ValueError(f"invalid scale: {scale}")
+
+    if max_bytes is not None:
+        if "jpg" not in typs:
+            raise ValueError(f"max_bytes is supported only for jpg, not {', '.join(typs)}")
+        if max_bytes < 1:
+            raise ValueError(f"invalid max_bytes: {max_bytes}")
+
+    return png_options
+
+
+def _browser_jpeg_quality(typs: list[str], quality: int, target_width: int | None, max_bytes: int | None) -> int | None:
+    """Return the quality to let the browser encode a jpeg with, or None if the screenshot must be a png."""
+
+    # A jpeg from the browser can not be resized to the target width, re-encoded to fit a budget,
+    # or encoded as other types.
+    if typs == ["jpg"] and target_width is None and max_bytes is None:
+        return quality
+    return None
+
+
+def _encode_screenshot(
+    data: bytes,
+    box: dict | None,
+    typs: list[str],
+    jpeg_quality: int | None = None,
+    trim_tolerance: int = 0,
+    quality: int = 75,
+    lossless: bool = False,
+    png_options: dict | None = None,
+    target_width: int | None = None,
+    max_bytes: int | None = None,
+    downscale: bool = False,
+    info: dict | None = None,
+    outs: list[str | os.PathLike | BinaryIO | None] | None = None,
+    hook: Callable[[str, str, dict], object] | None = None,
+) -> list[bytes | None]:
+    """
+    Trim a screenshot taken by ``_screenshot()`` if it is not clipped to ``box``, and encode it as every type in
+    ``typs``, see ``render_to_img()`` for the arguments.
 
     Returns:
-        bytes of png data.
+        list of the image data of every type, or None for a type whose ``outs`` item is specified.
     """
 
-    input_type = "tex_block"
-    if not block:
-        input_type = "tex_inline"
-    return convert(input_type, tex, typ)
+    if outs is None:
+        outs = [None] * len(typs)
+
+    if box is not None and jpeg_quality is not None:
+        # Already a jpeg of the content box
+        if info is not None:
+            from PIL import Image
+
+            info["width"], info["height"] = Image.open(io.BytesIO(data)).size
+        return [_write_out(outs[0], lambda f: f.write(data))]
+
+    with _Stage(hook, "render_to_img.trim"):
+        img = _trim(data, trim=box is None, tolerance=trim_tolerance, target_width=target_width, info=info)
+
+    results = []
+    for typ, out in zip(typs, outs):
+        save = functools.partial(
+            _save_image,
+            img,
+            typ=typ,
+            quality=quality,
+            lossless=lossless,
+            png_profile=png_options,
+            max_bytes=max_bytes,
+            downscale=downscale,
+            info=info,
+        )
+        with _Stage(hook, "render_to_img.encode", type=typ) as stage_info:
+            result = _write_out(out, save)
+            if result is not None:
+                stage_info["bytes"] = len(result)
+        results.append(result)
+    return results
+
+
+# Find the page area of the painted content: the union of the boxes of text, replaced elements such as images,
+# and elements with a background, border or shadow.
+# The box of a block element without any decoration is ignored, because it usually spans the window width.
+_content_box_js = """
+(() => {
+    const root = document.body || document.documentElement;
+    const range = document.createRange();
+    let left = Infinity, top = Infinity, right = -Infinity, bottom = -Infinity;
+
+    const add = (r) => {
+        if (r.width === 0 || r.height === 0) {
+            return;
+        }
+        left = Math.min(left, r.left);
+        top = Math.min(top, r.top);
+        right = Math.max(right, r.right);
+        bottom = Math.max(bottom, r.bottom);
+    };
+
+    const walker = document.createTreeWalker(root, NodeFilter.SHOW_ELEMENT | NodeFilter.SHOW_TEXT);
+    for (let n = walker.currentNode; n; n = walker.nextNode()) {
+        if (n.nodeType === Node.TEXT_NODE) {
+            if (n.data.trim() !== "") {
+                range.selectNodeContents(n);
+                for (const r of range.getClientRects()) {
+                    add(r);
+                }
+            }
+            continue;
+        }
+        if (n === document.body) {
+            continue;
+        }
+
+        const s = getComputedStyle(n);
+        const painted = n instanceof SVGSVGElement
+            || /^(IMG|CANVAS|VIDEO|IFRAME|OBJECT|EMBED|INPUT|TEXTAREA|SELECT|BUTTON|HR)$/.test(n.tagName)
+            || s.backgroundColor !== "rgba(0, 0, 0, 0)"
+            || s.backgroundImage !== "none"
+            || s.boxShadow !== "none"
+            || parseFloat(s.borderTopWidth) + parseFloat(s.borderRightWidth)
+               + parseFloat(s.borderBottomWidth) + parseFloat(s.borderLeftWidth) > 0;
+        if (painted) {
+            add(n.getBoundingClientRect());
+        }
+    }
 
+    return {
+        x: left + window.scrollX,
+        y: top + window.scrollY,
+        right: right + window.scrollX,
+        bottom: bottom + window.scrollY,
+    };
+})()
+"""
 
-def download(url: str) -> bytes:
-    """
-    Download content from ``url`` and return the responded data.
 
-    Args:
-        url(str): the url from which to download.
+def _content_box(page: Page) -> dict | None:
+    """Return the area of the content in css pixels, aligned to whole pixels, or None if nothing is rendered."""
+
+    return _box_of(page.evaluate(_content_box_js))
+
+
+def _box_of(r: dict) -> dict | None:
+    """Align the area evaluated by ``_content_box_js`` to whole pixels, or return None if it is empty."""
+
+    if not all(math.isfinite(v) for v in r.values()):
+        return None
+
+    x, y = math.floor(max(r["x"], 0)), math.floor(max(r["y"], 0))
+    w, h = math.ceil(r["right"]) - x, math.ceil(r["bottom"]) - y
+    if w <= 0 or h <= 0:
+        return None
+    return {"x": x, "y": y, "width": w, "height": h}
+
+
+def _screenshot(
+    mime: str,
+    content: str | bytes,
+    suffix: str,
+    width: int,
+    height: int,
+    asset_base: str | None,
+    via_file: bool,
+    clip: bool,
+    full_page: bool,
+    jpeg_quality: int | None,
+    scale: float = 2,
+    hook: Callable[[str, str, dict], object] | None = None,
+) -> tuple[bytes, dict | None]:
+    """
+    Load content in a page and take a png screenshot of the whole content. Runs in the render thread.
+    If it is clipped to the content box and ``jpeg_quality`` is specified, take a jpeg screenshot instead.
 
     Returns:
-        bytes of downloaded data.
+        the image data and the content box it is clipped to, or None if it is not clipped.
     """
 
-    resp = urllib.request.urlopen(url, timeout=30)
-    return resp.read()
+    with _checkout_page(width, height, scale, hook) as page:
+        _load_content(page, mime, content, suffix, asset_base, via_file, hook)
 
+        box = None
+        with _Stage(hook, "render_to_img.layout"):
+            if clip:
+                box = _content_box(page)
+            screenshot_args = _screenshot_args(clip, box, full_page, jpeg_quality)
 
-def web_to_img(pagefn: str, typ: str) -> bytes:
-    """
-    Render a web page, which could be html, svg etc into image.
+            if box is None and not full_page:
+                content_height = page.evaluate("document.documentElement.scrollHeight")
+                if content_height > height:
+                    page.set_viewport_size({"width": width, "height": content_height})
 
-    Args:
-        pagefn(string): path to a local file that can be rendered in a browser.
+        with _Stage(hook, "render_to_img.screenshot") as info:
+            data = page.screenshot(**screenshot_args)
+            info["bytes"] = len(data)
 
-        typ(string): specify output image type such as "png", "jpg"
+        return data, box
 
-    Returns:
-        bytes of the image data
+
+def _screenshot_args(clip: bool, box: dict | None, full_page: bool, jpeg_quality: int | None) -> dict:
+    """Build the arguments of ``Page.screenshot()`` to capture the content ``box``, or the page if it is None."""
+
+    if box is None:
+        if clip:
+            logger.info("content box not found, capture the whole page")
+        return {"omit_background": True, "full_page": full_page}
+
+    if jpeg_quality is not None:
+        # jpeg has no alpha: keep the default white page background.
+        return {"type": "jpeg", "quality": jpeg_quality, "clip": box, "full_page": True}
+    return {"omit_background": True, "clip": box, "full_page": True}
+
+
+def _load_content(
+    page: Page,
+    mime: str,
+    content: str | bytes,
+    suffix: str,
+    asset_base: str | None,
+    via_file: bool,
+    hook: Callable[[str, str, dict], object] | None = None,
+) -> None:
+    """Load content in a page from memory, or from a temp file if ``via_file``."""
+
+    if not via_file:
+        with _Stage(hook, "render_to_img.goto"):
+            _load_document(page, mime, content, suffix, asset_base)
+        return
+
+    with tempfile.TemporaryDirectory() as tdir:
+        fn = os.path.join(tdir, "xxx." + suffix)
+        flags = "w"
+        if isinstance(content, bytes):
+            flags = "wb"
+        with _Stage(hook, "render_to_img.write_file") as info:
+            with open(fn, flags) as f:
+                f.write(content)
+            info["bytes"] = os.path.getsize(fn)
+
+        with _Stage(hook, "render_to_img.goto"):
+            page.goto(pathlib.Path(fn).as_uri())
+
+
+def _content_width(
+    mime: str,
+    content: str | bytes,
+    suffix: str,
+    width: int,
+    height: int,
+    asset_base: str | None,
+    via_file: bool,
+    hook: Callable[[str, str, dict], object] | None = None,
+) -> float:
+    """
+    Lay out content in a page of scale 1 and return the width in CSS pixels of the painted content,
+    or of the document if nothing is painted. Runs in the render thread.
     """
 
-    intyp = pagefn.rsplit(".")[-1]
-    page = fread(pagefn)
-    return render_to_img(intyp, page, typ)
+    with _checkout_page(width, height, 1, hook) as page:
+        _load_content(page, mime, content, suffix, asset_base, via_file, hook)
 
+        box = _content_box(page)
+        if box is not None:
+            return box["width"]
+        return page.evaluate("document.documentElement.scrollWidth")
 
-def _trim_and_convert(png_data: bytes, typ: str) -> bytes:
-    """Trim whitespace borders from a screenshot and convert to the target format."""
-    img = Image.open(io.BytesIO(png_data))
 
-    # Trim borders matching the corner pixel color (like ImageMagick -trim).
-    bg = Image.new(img.mode, img.size, img.getpixel((0, 0)))
-    diff = ImageChops.difference(img, bg)
-    bbox = diff.getbbox()
-    if bbox:
-        img = img.crop(bbox)
+def _scale_for_width(target_width: int, content_width: float) -> float:
+    """
+    Choose a device scale factor to render content of ``content_width`` CSS pixels at least ``target_width`` pixels
+    wide. It is rounded up to a multiple of ``1/8``, so that renders of similar sizes share pooled pages,
+    and the image is then resized to exactly ``target_width``.
+    """
+
+    if content_width <= 0:
+        return 1
+    return max(math.ceil(target_width / content_width * 8), 1) / 8
 
-    buf = io.BytesIO()
-    if typ == "png":
-        img.save(buf, format="PNG")
-    else:
-        background = Image.new("RGB", img.size, (255, 255, 255))
-        if img.mode == "RGBA":
-            background.paste(img, mask=img.split()[3])
-        else:
-            background.paste(img)
-        background.save(buf, format="JPEG")
 
-    return buf.getvalue()
+# Find the page area of every snippet laid out by ``render_many``.
+_item_boxes_js = """
+Array.from(document.querySelectorAll("body > .k3down2-item"), e => {
+    const r = e.getBoundingClientRect();
+    return {x: r.x + window.scrollX, y: r.y + window.scrollY, width: r.width, height: r.height};
+})
+"""
 
 
-def render_to_img(
-    mime: str, content: str | bytes, typ: str, width: int = 1000, height: int = 2000, asset_base: str | None = None
-) -> bytes:
+def render_many(
+    mime: str,
+    contents: list[str | bytes],
+    typ: str,
+    width: int = 1000,
+    height: int = 2000,
+    asset_base: str | None = None,
+    scale: float = 2,
+) -> list[bytes]:
     """
-    Render content that is renderable in a browser to image.
-    Such as html, svg etc into image.
-    Uses Playwright (Chromium) for rendering and Pillow for image processing.
+    Render several snippets to images with one page load.
+    The snippets are laid out one after another in a single page and each image is captured by the area of a snippet.
+    It is much faster than calling ``render_to_img`` for every snippet,
+    e.g. to render all the tables or code blocks in an article.
+
+    html snippets share one document, thus a ``<style>`` in one snippet applies to all of them.
+    Other content such as svg is embedded with an ``<img>`` tag.
 
     Args:
-        mime(str): a full mime type such as ``image/jpeg`` or a shortcut ``jpg``.
+        mime(str): a full mime type such as ``image/svg+xml`` or a shortcut ``html``.
 
-        content(str): content to render, such as jpeg data or svg source.
+        contents(list): snippets to render.
 
         typ(string): specifies output image type such as "png", "jpg"
 
@@ -367,43 +2446,58 @@ def render_to_img(
 
         asset_base(str): specifies the path to assets dir. E.g. the image base path in a html page.
 
+        scale(float): device scale factor, i.e. image pixels per CSS pixel. Default 2.
+
     Returns:
-        bytes of the image data
+        list of bytes of the image data, in the same order as ``contents``.
     """
 
-    if "html" in mime:
-        content = r'<meta http-equiv="Content-Type" content="text/html; charset=utf-8"/>' + content
+    if scale <= 0:
+        raise ValueError(f"invalid scale: {scale}")
 
-        if asset_base is not None:
-            base_uri = pathlib.Path(asset_base).as_uri()
-            content = '<base href="{}/">'.format(base_uri) + content
+    if len(contents) == 0:
+        return []
 
     m = mimetypes.get(mime) or mime
-    suffix = mime_to_suffix.get(m, mime)
 
-    with tempfile.TemporaryDirectory() as tdir:
-        fn = os.path.join(tdir, "xxx." + suffix)
-        flags = "w"
-        if isinstance(content, bytes):
-            flags = "wb"
-        with open(fn, flags) as f:
-            f.write(content)
+    items = []
+    for content in contents:
+        if "html" not in m:
+            data = base64.b64encode(to_bytes(content)).decode("ascii")
+            content = '<img src="data:{};base64,{}">'.format(m, data)
 
-        browser = _get_browser()
-        page = browser.new_page(
-            viewport={"width": width, "height": height},
-            device_scale_factor=2,
-        )
-        page.goto(pathlib.Path(fn).as_uri())
+        # ``flow-root`` keeps margins and floats of a snippet inside its own box.
+        items.append('<div class="k3down2-item" style="display: flow-root;">' + content + "</div>")
 
-        content_height = page.evaluate("document.documentElement.scrollHeight")
-        if content_height > height:
-            page.set_viewport_size({"width": width, "height": content_height})
+    page_html = _html_meta + "\n".join(items)
 
-        png_data = page.screenshot(omit_background=True)
-        page.close()
+    shots = _in_render_thread(_render, _screenshot_items, page_html, len(contents), width, height, asset_base, scale)
+    return [_trim_and_convert(png_data, typ) for png_data in shots]
+
+
+def _screenshot_items(
+    page_html: str, n: int, width: int, height: int, asset_base: str | None, scale: float = 2
+) -> list[bytes]:
+    """Load a page of ``n`` snippets and take a png screenshot of each of them. Runs in the render thread."""
 
-    return _trim_and_convert(png_data, typ)
+    with _checkout_page(width, height, scale) as page:
+        _load_document(page, "text/html", page_html, "html", asset_base)
+
+        boxes = page.evaluate(_item_boxes_js)
+        if len(boxes) != n:
+            raise ValueError(
+                f"snippets can not be separated, maybe some snippet has unclosed tags:"
+                f" found {len(boxes)} boxes for {n} snippets"
+            )
+
+        shots = []
+        for box in boxes:
+            # An empty snippet has an empty box, which is not a valid clip.
+            box["width"] = max(box["width"], 1)
+            box["height"] = max(box["height"], 1)
+            shots.append(page.screenshot(clip=box, full_page=True, omit_background=True))
+
+        return shots
 
 
 html_style = """
@@ -451,68 +2545,298 @@ html_style = """
 """
 
 
-def md_to_html(md: str) -> str:
+def code_to_html(text: str) -> str:
+    """
+    Build a fenced code block into html with syntax highlighting.
+
+    Args:
+        text(str): markdown source of a code block, including the fence lines.
+            The language is specified after the opening fence.
+
+    Returns:
+        str of html
+    """
+
+    from .syntax_highlight import code_to_html
+
+    return code_to_html(text)
+
+
+def _source_args(src: str | bytes | os.PathLike) -> tuple[list[str], str | bytes | None]:
+    """
+    Pass source to a command: a path, e.g. a ``pathlib.Path``, as a file argument for the command to read,
+    other source through stdin.
+
+    Returns:
+        the file arguments and the stdin input.
+    """
+
+    if isinstance(src, os.PathLike):
+        return [os.fspath(src)], None
+    return [], src
+
+
+# The pandoc server used instead of running pandoc, see ``set_pandoc_backend()``.
+_pandoc_server: PandocServer | None = None
+
+
+def set_pandoc_backend(backend: str | PandocServer = "subprocess", **kwargs) -> None:
+    """
+    Choose how ``md_to_html()``, ``mdtable_to_barehtml()`` and their batched versions run pandoc.
+    It can be changed at any time, e.g. to use a server in a long running service::
+
+        set_pandoc_backend("server", pool_size=16)
+
+    Args:
+        backend(str|PandocServer):
+
+            - ``"subprocess"``: run a pandoc process for every conversion. The default.
+            - ``"server"``: send conversions to a ``pandoc server`` child process,
+              which saves the start up of pandoc. It is launched at the first conversion, or by ``warmup()``.
+              If it can not be launched, e.g. pandoc is older than 2.18, or a conversion fails,
+              pandoc is run as a subprocess instead.
+              pandoc listens on a random port of **all network interfaces**, without authentication,
+              because it can not be bound to the loopback interface only.
+              Any host that can reach the machine can send conversions to it while it runs,
+              thus use it only on a trusted network or behind a firewall. A warning is logged when it is launched.
+            - A ``PandocServer`` to use.
+
+        **kwargs: arguments to create a ``PandocServer`` with, for ``"server"``.
+    """
+
+    global _pandoc_server
+
+    if isinstance(backend, str):
+        if backend == "subprocess":
+            server = None
+        elif backend == "server":
+            from .pandoc_server import PandocServer
+
+            server = PandocServer(**kwargs)
+        else:
+            raise ValueError(f"unknown pandoc backend: {backend}")
+    else:
+        server = backend
+
+    old, _pandoc_server = _pandoc_server, server
+    if old is not None and old is not server:
+        old.stop()
+
+
+def md_to_html(md: str | os.PathLike) -> str:
     """
     Build markdown source into html.
 
     Args:
-        md(str): markdown source.
+        md(str|PathLike): markdown source, or the path to a markdown file, e.g. a ``pathlib.Path``,
+            which is read by pandoc directly.
 
     Returns:
         str of html
     """
 
-    _, html, _ = k3proc.command_ex(
-        "pandoc",
-        "-f",
-        "markdown",
-        "-t",
-        "html",
-        input=md,
-    )
+    return html_style + _pandoc_to_html(md)
+
+
+def md_to_html_many(mds: list[str | os.PathLike]) -> list[str]:
+    """
+    Build many markdown fragments into html with one pandoc run, instead of starting pandoc for each of them.
+    The result of every fragment is the same as ``md_to_html()``.
+
+    A fragment that depends on the rest of a document, such as one with footnotes, reference links or headings,
+    and a path to a file, are converted by a pandoc run of their own.
+
+    Args:
+        mds(list): markdown sources or paths to markdown files.
+
+    Returns:
+        list of str of html, in the same order as ``mds``.
+    """
 
-    return html_style + html
+    return [html_style + html for html in _pandoc_to_html_many(mds)]
 
 
-def mdtable_to_barehtml(md: str) -> str:
+# A table with wide column will cause pandoc to produce ``colgroup`` tag, which is not recognized by zhihu.
+# Reported in:
+#      https://github.com/drmingdrmer/md2zhihu/issues/22
+#
+# Thus we have to set a very big rendering window to disable this behavior
+#      https://github.com/jgm/pandoc/issues/2574
+_pandoc_table_columns = 100000
+
+
+def mdtable_to_barehtml(md: str | os.PathLike) -> str:
     """
     Build markdown table into html without style.
 
     Args:
-        md(str): markdown source.
+        md(str|PathLike): markdown source, or the path to a markdown file, e.g. a ``pathlib.Path``,
+            which is read by pandoc directly.
 
     Returns:
         str of html
     """
 
-    # A table with wide column will cause pandoc to produce ``colgroup`` tag, which is not recognized by zhihu.
-    # Reported in:
-    #      https://github.com/drmingdrmer/md2zhihu/issues/22
-    #
-    # Thus we have to set a very big rendering window to disable this behavior
-    #      https://github.com/jgm/pandoc/issues/2574
+    return _bare_table(_pandoc_to_html(md, columns=_pandoc_table_columns))
+
+
+def mdtable_to_barehtml_many(mds: list[str | os.PathLike]) -> list[str]:
+    """
+    Build many markdown tables into html without style with one pandoc run, see ``md_to_html_many()``.
+    The result of every table is the same as ``mdtable_to_barehtml()``.
+
+    Args:
+        mds(list): markdown sources or paths to markdown files.
+
+    Returns:
+        list of str of html, in the same order as ``mds``.
+    """
+
+    return [_bare_table(html) for html in _pandoc_to_html_many(mds, columns=_pandoc_table_columns)]
+
+
+def _bare_table(html: str) -> str:
+    lines = html.strip().split("\n")
+    lines = [x for x in lines if x not in ("<thead>", "</thead>", "<tbody>", "</tbody>")]
+
+    return "\n".join(lines)
+
+
+def _pandoc_to_html(md: str | os.PathLike, columns: int | None = None) -> str:
+    """
+    Convert markdown to html by the pandoc server if it is selected by ``set_pandoc_backend()``,
+    or by running pandoc.
+    """
+
+    server = _pandoc_server
+    if server is not None and server.available:
+        from .pandoc_server import PandocServerError
 
+        text = pathlib.Path(md).read_text(encoding="utf-8") if isinstance(md, os.PathLike) else md
+        try:
+            return server.convert(text, {} if columns is None else {"columns": columns})
+        except PandocServerError as e:
+            logger.info("pandoc server failed, run pandoc instead: %s", e)
+
+    args = () if columns is None else ("--column", str(columns))
+    files, src = _source_args(md)
     _, html, _ = k3proc.command_ex(
         "pandoc",
         "-f",
         "markdown",
         "-t",
         "html",
-        "--column",
-        "100000",
-        input=md,
+        *args,
+        *files,
+        input=src,
     )
-    lines = html.strip().split("\n")
-    lines = [x for x in lines if x not in ("<thead>", "</thead>", "<tbody>", "</tbody>")]
+    return html
 
-    return "\n".join(lines)
+
+# Markdown whose html depends on the rest of the document: footnotes, reference links, example lists,
+# headings, whose ids are unique in a document, and metadata blocks;
+# html comments and processing instructions, which may run to the end of the next separator;
+# and divs, which are closed at the end of the document if they are not closed, around the fragments after them.
+# A false positive only costs a pandoc run of its own.
+_context_dependent_md = re.compile(
+    r"\[\^|\^\[|\(@|^ {0,3}\[[^\]]+\]:|^ {0,3}#|^ {0,3}(=+|-+)[ \t]*$|^%|<!--|<\?|<div|^ {0,3}:::", re.M | re.I
+)
+
+
+def _pandoc_to_html_many(mds: list[str | os.PathLike], columns: int | None = None) -> list[str]:
+    """
+    Convert markdown fragments to html by one pandoc run, see ``_pandoc_to_html()``.
+    A fragment that can not be converted along with others is converted alone.
+
+    Returns:
+        list of html of every fragment, the same as a pandoc run for each of them.
+    """
+
+    results: list[str | None] = [None] * len(mds)
+
+    batch = [
+        i for i, md in enumerate(mds) if isinstance(md, str) and md.strip() and not _context_dependent_md.search(md)
+    ]
+    _pandoc_batch_into(mds, batch, columns, results)
+
+    for i, md in enumerate(mds):
+        if results[i] is None:
+            results[i] = _pandoc_to_html(md, columns)
+
+    return results
+
+
+def _pandoc_batch_into(mds: list[str], batch: list[int], columns: int | None, results: list[str | None]) -> None:
+    """
+    Convert the fragments ``batch`` of ``mds`` in batches and store the html in ``results``.
+    If a fragment breaks the separators, the fragments before it are kept, it is left to be converted alone,
+    and the fragments after it are batched again.
+    If the output is broken by a fragment that can not be told, the batch is split in halves.
+    """
+
+    while len(batch) > 1:
+        htmls = _pandoc_batch([mds[i] for i in batch], columns)
+        if htmls is None:
+            half = len(batch) // 2
+            _pandoc_batch_into(mds, batch[:half], columns, results)
+            batch = batch[half:]
+            continue
+
+        for i, html in zip(batch, htmls):
+            results[i] = html
+        batch = batch[len(htmls) + 1 :]
 
 
-def mermaid_to_svg(mmd: str) -> str:
+def _pandoc_batch(mds: list[str], columns: int | None) -> list[str] | None:
+    """
+    Convert markdown fragments by one pandoc run, separated by html comments with a random token.
+    A comment is passed through by pandoc on a line of its own, between the html of two fragments.
+
+    Returns:
+        list of html of the leading fragments that are delimited by the separators as expected.
+        It is shorter than ``mds`` if a fragment breaks them, e.g. an unclosed code fence swallows the separators
+        up to a fence in a later fragment: the fragments from that one on are not converted.
+        None if all the separators are found but there is output after the last one,
+        i.e. a fragment changed the html around the others.
+    """
+
+    import secrets
+
+    token = secrets.token_hex(8)
+    parts = []
+    for i, md in enumerate(mds):
+        parts.append(f"<!-- k3down2-fragment-{token}-{i} -->")
+        parts.append(md)
+    parts.append(f"<!-- k3down2-fragment-{token}-{len(mds)} -->")
+
+    html = _pandoc_to_html("\n\n".join(parts) + "\n", columns)
+
+    # [before, "0", html of 0, "1", html of 1, ..., "n", after]
+    pieces = re.split(rf"^<!-- k3down2-fragment-{token}-(\d+) -->\n", html, flags=re.M)
+    indexes = pieces[1::2]
+    n = 0
+    if pieces[0] == "" and indexes[:1] == ["0"]:
+        # Separators ``0`` to ``n`` are found in order, around fragments ``0`` to ``n - 1``.
+        while n + 1 < len(indexes) and indexes[n + 1] == str(n + 1):
+            n += 1
+        if n == len(mds) and pieces[-1] != "":
+            logger.info("output after the last separator in batched pandoc output, split the batch")
+            return None
+
+    if n < len(mds):
+        logger.info("fragment %d breaks separators in batched pandoc output, convert it alone", n)
+    return pieces[2 : 2 * n + 1 : 2]
+
+
+def mermaid_to_svg(mmd: str | os.PathLike) -> str:
     """
     Render mermaid to svg.
     See: https://mermaid-js.github.io/mermaid/#
 
+    Args:
+        mmd(str|PathLike): mermaid source, or the path to a mermaid file, e.g. a ``pathlib.Path``,
+            which is read by ``mmdc`` directly.
+
     Requires:
         npm install @mermaid-js/mermaid-cli
     """
@@ -533,35 +2857,129 @@ def mermaid_to_svg(mmd: str) -> str:
         with open(config_file_path, "w") as f:
             f.write(json.dumps(puppeteer_config))
 
+        files, src = _source_args(mmd)
+        if files:
+            files = ["-i", *files]
+
         k3proc.command_ex(
             "npm",
             "exec",
             "--",
             "mmdc",
+            *files,
             "-o",
             output_path,
             "--puppeteerConfigFile",
             config_file_path,
-            input=mmd,
+            input=src,
         )
         return fread(output_path)
 
 
-def graphviz_to_img(gv: str | bytes, typ: str) -> bytes:
+def graphviz_to_img(
+    gv: str | bytes | os.PathLike,
+    typ: str,
+    png_profile: str | dict | None = None,
+    quality: int = 75,
+    lossless: bool = False,
+    out: str | os.PathLike | BinaryIO | None = None,
+) -> bytes | None:
     """
     Render graphviz source to image.
 
+    Args:
+        gv(str|PathLike): graphviz source, or the path to a graphviz file, e.g. a ``pathlib.Path``,
+            which is read by ``dot`` directly.
+
+        typ(str): output type such as "svg", "png" or "jpg".
+            "webp" and "avif" are encoded by Pillow from the png of ``dot``.
+
+        png_profile(str|dict): re-encode a png output with a png profile, see ``render_to_img()``.
+            Default None, i.e. the png from ``dot``.
+
+        quality(int): lossy webp or avif quality from 0 to 100. Default 75.
+
+        lossless(bool): encode webp losslessly, or avif nearly losslessly. Default False.
+
+        out(str|PathLike|BinaryIO): a path or a writable binary stream to write the image to,
+            instead of returning it. ``dot`` writes to a path directly. Default None.
+
+    Returns:
+        bytes of the image data, or None if ``out`` is specified.
+
     Requires:
         brew install graphviz
     """
 
-    _, out, _ = k3proc.command_ex(
-        "dot",
-        "-T" + typ,
-        input=to_bytes(gv),
-        text=False,
-    )
-    return out
+    png_options = _png_options(png_profile)
+    _check_image_type(typ)
+
+    # Not every build of dot has webp, none has avif.
+    pillow_encoded = typ in ("webp", "avif")
+    reencoded = pillow_encoded or (typ == "png" and png_profile is not None)
+
+    files, src = _source_args(gv)
+    if src is not None:
+        src = to_bytes(src)
+    args = ["dot", "-Tpng" if pillow_encoded else "-T" + typ, *files]
+
+    if out is not None and not reencoded and not hasattr(out, "write"):
+        with _atomic_path(out) as tmp:
+            k3proc.command_ex(*args, "-o", tmp, input=src, text=False)
+        return None
+
+    _, data, _ = k3proc.command_ex(*args, input=src, text=False)
+
+    if reencoded:
+        from PIL import Image
+
+        img = Image.open(io.BytesIO(data))
+        return _write_out(
+            out, lambda f: _save_image(img, f, typ, quality=quality, lossless=lossless, png_profile=png_options)
+        )
+
+    return _write_out(out, lambda f: f.write(data))
+
+
+@contextlib.contextmanager
+def _atomic_path(path: str | os.PathLike):
+    """
+    Yield a temp path in the directory of ``path`` to write to, and move it to ``path`` on success,
+    so that a reader never sees a partial file.
+    """
+
+    path = os.fspath(path)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".k3down2-")
+    os.close(fd)
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+
+def _write_out(out: str | os.PathLike | BinaryIO | None, write: Callable[[BinaryIO], object]) -> bytes | None:
+    """
+    Call ``write`` with a binary stream to write a result to ``out``:
+    a path, which is replaced atomically, or a writable binary stream.
+    If ``out`` is None, the result is written to memory and returned.
+    """
+
+    if out is None:
+        buf = io.BytesIO()
+        write(buf)
+        return buf.getvalue()
+
+    if hasattr(out, "write"):
+        write(out)
+        return None
+
+    with _atomic_path(out) as tmp:
+        with open(tmp, "wb") as f:
+            write(f)
+    return None
 
 
 def to_bytes(s: str | bytes) -> bytes:
@@ -579,40 +2997,111 @@ def fread(*p: str) -> str:
         return f.read()
 
 
-mappings = {
-    ("md", "html"): md_to_html,
-    ("md", "jpg"): "html",
-    ("md", "png"): "html",
-    ("html", "jpg"): lambda x, **kwargs: render_to_img("html", x, "jpg", **kwargs),
-    ("html", "png"): lambda x, **kwargs: render_to_img("html", x, "png", **kwargs),
+class _Mappings(dict):
+    """
+    The registry of conversions: ``Converter`` values keyed by ``(input_typ, output_typ)``.
+    A plain callable set in it is registered as a ``Converter`` of the default cost,
+    a type name pins the route of the conversion through that type.
+    It drops the routes and plans cached by ``convert()`` when it is modified.
+    """
+
+    def _invalidate(self) -> None:
+        _route_cache.clear()
+        _plan_cache.clear()
+
+    def __setitem__(self, key, value):
+        if callable(value) and not isinstance(value, Converter):
+            value = Converter(key[0], key[1], value)
+        super().__setitem__(key, value)
+        self._invalidate()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._invalidate()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._invalidate()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._invalidate()
+        return item
+
+    def clear(self):
+        super().clear()
+        self._invalidate()
+
+
+# Output types rendered by a browser.
+_image_types = ("jpg", "png", "webp", "avif")
+
+mappings = _Mappings()
+
+
+def _register_builtin_converters() -> None:
+    # Costs are rough milliseconds per call of a warm process.
+    register_converter("md", "html", md_to_html, cost=30, requires=["pandoc"])
     # markdown table
-    ("table", "html"): mdtable_to_barehtml,
-    ("table", "jpg"): "html",
-    ("table", "png"): "html",
-    ("mermaid", "svg"): mermaid_to_svg,
-    ("mermaid", "jpg"): "svg",
-    ("mermaid", "png"): "svg",
-    ("graphviz", "svg"): lambda x: graphviz_to_img(x, "svg"),
-    ("graphviz", "jpg"): lambda x: graphviz_to_img(x, "jpg"),
-    ("graphviz", "png"): lambda x: graphviz_to_img(x, "png"),
-    ("tex_block", "url"): lambda x: tex_to_zhihu_url(x, True),
-    ("tex_inline", "url"): lambda x: tex_to_zhihu_url(x, False),
-    ("tex_block", "imgtag"): lambda x: tex_to_zhihu(x, True),
-    ("tex_inline", "imgtag"): lambda x: tex_to_zhihu(x, False),
-    ("url", "jpg"): download,
-    ("url", "png"): download,
-    ("url", "svg"): download,
-    ("url", "html"): download,
-    ("tex_block", "jpg"): "svg",
-    ("tex_inline", "jpg"): "svg",
-    ("tex_block", "png"): "svg",
-    ("tex_inline", "png"): "svg",
-    ("tex_block", "svg"): "url",
-    ("tex_inline", "svg"): "url",
-    ("tex_inline", "plain"): tex_to_plain,
-    ("svg", "jpg"): lambda x: render_to_img("svg", x, "jpg"),
-    ("svg", "png"): lambda x: render_to_img("svg", x, "png"),
-    ("code", "html"): code_to_html,
-    ("code", "jpg"): "html",
-    ("code", "png"): "html",
-}
+    register_converter("table", "html", mdtable_to_barehtml, cost=30, requires=["pandoc"])
+    register_converter("code", "html", code_to_html, cost=5)
+    register_converter("mermaid", "svg", mermaid_to_svg, cost=1500, requires=["mmdc"])
+
+    for frm in ("html", "svg"):
+        # One screenshot is encoded as all the image types wanted by ``convert_multi()``.
+        multi_fn = functools.partial(_render_to_imgs, frm)
+        for typ in _image_types:
+            fn = functools.partial(render_to_img, frm, typ=typ)
+            register_converter(frm, typ, fn, cost=100, sink=True, requires=["browser"], multi_fn=multi_fn)
+
+    # dot renders an image itself, much cheaper than a browser. webp and avif are re-encoded from png.
+    for typ in ("svg", "jpg", "png", "webp", "avif"):
+        fn = functools.partial(graphviz_to_img, typ=typ)
+        cost = 30 if typ in ("webp", "avif") else 20
+        register_converter("graphviz", typ, fn, cost=cost, sink=True, requires=["dot"])
+
+    register_converter("tex_block", "url", lambda x: tex_to_zhihu_url(x, True), cost=0.01)
+    register_converter("tex_inline", "url", lambda x: tex_to_zhihu_url(x, False), cost=0.01)
+    register_converter("tex_block", "imgtag", lambda x: tex_to_zhihu(x, True), cost=0.01)
+    register_converter("tex_inline", "imgtag", lambda x: tex_to_zhihu(x, False), cost=0.01)
+    register_converter("tex_inline", "plain", tex_to_plain, cost=5)
+
+    # The zhihu equation url responds svg.
+    register_converter("url", "svg", download, cost=300, sink=True, requires=["network"])
+    # Other urls are downloaded as they are: only the caller knows what a url is.
+    for typ in ("jpg", "png", "html"):
+        register_converter("url", typ, download, cost=300, sink=True, requires=["network"], source_only=True)
+
+    # The indirect entries of the former table, kept for code reading ``mappings``.
+    # They pin the routes the router would choose anyway.
+    mappings.update(
+        {
+            ("md", "jpg"): "html",
+            ("md", "png"): "html",
+            ("table", "jpg"): "html",
+            ("table", "png"): "html",
+            ("code", "jpg"): "html",
+            ("code", "png"): "html",
+            ("mermaid", "jpg"): "svg",
+            ("mermaid", "png"): "svg",
+            ("tex_block", "jpg"): "svg",
+            ("tex_inline", "jpg"): "svg",
+            ("tex_block", "png"): "svg",
+            ("tex_inline", "png"): "svg",
+            ("tex_block", "svg"): "url",
+            ("tex_inline", "svg"): "url",
+        }
+    )
+
+
+_register_builtin_converters()
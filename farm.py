@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Run conversions in a pool of worker processes, each of which owns a warm browser,
+so that rendering scales with CPU cores instead of being limited to one browser driven by one thread.
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+
+from . import down2
+from .cache import ResultCache
+
+logger = logging.getLogger(__name__)
+
+
+def _init_worker(cache: ResultCache | None) -> None:
+    down2.set_result_cache(cache)
+
+    # Launch the browser before the first task arrives.
+    # A failure is reported by the tasks that render, not by breaking the pool.
+    try:
+        down2.warmup()
+    except Exception as e:
+        logger.warning("failed to launch browser in worker %d: %r", os.getpid(), e)
+
+
+class RenderFarm:
+    """
+    A pool of worker processes running ``convert`` and ``render_to_img``.
+    Tasks are queued and dispatched to the next idle worker;
+    results are returned to the caller through futures.
+
+    Use it as a context manager, or call ``shutdown()`` to stop the workers and close their browsers::
+
+        with RenderFarm(workers=8) as farm:
+            imgs = farm.map_convert("table", tables, "png")
+
+    Args:
+        workers(int): number of worker processes. Default is the number of CPU cores.
+
+        cache(ResultCache): a result cache for ``convert`` in the workers, see ``set_result_cache()``.
+            Every worker has its own memory tier and shares the disk tier. Default None.
+    """
+
+    def __init__(self, workers: int | None = None, cache: ResultCache | None = None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 1:
+            raise ValueError(f"invalid number of workers: {workers}")
+
+        self.workers = workers
+
+        # Do not fork: the parent may have started playwright, whose driver connection must not be shared.
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(cache,),
+        )
+
+    def submit_convert(
+        self, input_typ: str, content: str | bytes, output_typ: str, opt: dict[str, dict] | None = None
+    ) -> concurrent.futures.Future:
+        """Schedule a ``convert`` and return a future of its result."""
+        return self._executor.submit(down2.convert, input_typ, content, output_typ, opt)
+
+    def submit_render_to_img(self, mime: str, content: str | bytes, typ: str, **kwargs) -> concurrent.futures.Future:
+        """Schedule a ``render_to_img`` and return a future of its result."""
+        return self._executor.submit(down2.render_to_img, mime, content, typ, **kwargs)
+
+    def convert(
+        self, input_typ: str, content: str | bytes, output_typ: str, opt: dict[str, dict] | None = None
+    ) -> str | bytes:
+        """Run ``convert`` in a worker and wait for the result."""
+        return self.submit_convert(input_typ, content, output_typ, opt).result()
+
+    def render_to_img(self, mime: str, content: str | bytes, typ: str, **kwargs) -> bytes:
+        """Run ``render_to_img`` in a worker and wait for the result."""
+        return self.submit_render_to_img(mime, content, typ, **kwargs).result()
+
+    def map_convert(
+        self, input_typ: str, contents: list[str | bytes], output_typ: str, opt: dict[str, dict] | None = None
+    ) -> list[str | bytes]:
+        """
+        Convert every item in ``contents`` concurrently with all workers.
+
+        Returns:
+            list of results in the same order as ``contents``.
+        """
+
+        futures = [self.submit_convert(input_typ, c, output_typ, opt) for c in contents]
+        return [f.result() for f in futures]
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False) -> None:
+        """
+        Stop the workers.
+        A worker closes its browser when it exits.
+
+        Args:
+            wait(bool): whether to wait for queued tasks to finish and for the workers to exit.
+
+            cancel_futures(bool): whether to cancel tasks not yet started.
+        """
+        self._executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    def __enter__(self) -> RenderFarm:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Convert markdown by a long-lived ``pandoc server`` child process instead of starting pandoc for every conversion.
+Select it with ``set_pandoc_backend("server")``.
+"""
+
+from __future__ import annotations
+
+import atexit
+import base64
+import json
+import logging
+import queue
+import socket
+import subprocess
+import threading
+import time
+from typing import TYPE_CHECKING
+
+# http.client is slow to import, thus it is imported when a server is launched.
+if TYPE_CHECKING:
+    import http.client
+
+logger = logging.getLogger(__name__)
+
+
+class PandocServerError(Exception):
+    """The pandoc server can not be started, or failed to respond to a conversion."""
+
+
+class PandocServer:
+    """
+    A ``pandoc server`` child process, launched at the first conversion and relaunched if it dies.
+    Requests are sent over pooled keep-alive connections, thus it is safe to use from many threads.
+
+    After a failed launch, or after ``max_restarts`` relaunches, it is no longer ``available``,
+    and ``convert`` raises ``PandocServerError`` at once, to let the caller fall back to running pandoc.
+
+    pandoc listens on all interfaces without authentication, and can not be told otherwise,
+    thus any host that can reach the machine can send conversions to it; a warning is logged at every launch.
+    It only converts the text sent to it, without reading or writing files.
+
+    Args:
+        command(tuple): the command to run the server, the port and the timeout are appended.
+            Default ``("pandoc", "server")``.
+
+        pool_size(int): max number of idle connections kept for reuse. Default 8.
+
+        timeout(float): seconds a conversion may take. Default 30.
+
+        start_timeout(float): seconds to wait for the server to accept connections. Default 10.
+
+        max_restarts(int): max number of relaunches after the server dies. Default 3.
+    """
+
+    def __init__(
+        self,
+        command: tuple[str, ...] = ("pandoc", "server"),
+        pool_size: int = 8,
+        timeout: float = 30,
+        start_timeout: float = 10,
+        max_restarts: int = 3,
+    ):
+        if pool_size < 0:
+            raise ValueError(f"invalid pool size: {pool_size}")
+        if timeout <= 0:
+            raise ValueError(f"invalid timeout: {timeout}")
+
+        self.command = tuple(command)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.start_timeout = start_timeout
+        self.max_restarts = max_restarts
+
+        self._lock = threading.Lock()
+        self._proc: subprocess.Popen | None = None
+        self._port: int | None = None
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._failed = False
+        self._atexit = False
+
+        self._stats = {"launches": 0, "restarts": 0, "requests": 0, "errors": 0, "connections": 0}
+
+    @property
+    def available(self) -> bool:
+        """Whether it is running or can be launched."""
+        return not self._failed
+
+    def start(self) -> None:
+        """
+        Launch the server if it is not running, and check that it converts.
+        Raise ``PandocServerError`` if it fails.
+        """
+
+        with self._lock:
+            self._ensure_running()
+
+    def convert(self, text: str, options: dict | None = None) -> str:
+        """
+        Convert ``text`` and return the output, ending with a newline like the output of the pandoc command.
+
+        Args:
+            text(str): the source to convert.
+
+            options(dict): options of the conversion in the json form of ``pandoc server``,
+                e.g. ``{"from": "markdown", "to": "html", "columns": 100000}``. Default None, i.e. markdown to html.
+
+        Returns:
+            str of the output.
+        """
+
+        import http.client
+
+        body = json.dumps({"from": "markdown", "to": "html", **(options or {}), "text": text}).encode("utf-8")
+
+        # A pooled connection may have been closed by the server, or the server may have died: retry once.
+        retried = False
+        while True:
+            with self._lock:
+                self._ensure_running()
+                port = self._port
+
+            conn = self._checkout(port)
+            try:
+                conn.request(
+                    "POST", "/", body=body, headers={"Content-Type": "application/json", "Accept": "application/json"}
+                )
+                resp = conn.getresponse()
+                status, data = resp.status, resp.read()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                with self._lock:
+                    self._stats["errors"] += 1
+                if retried:
+                    raise PandocServerError(f"pandoc server failed: {e!r}") from e
+                retried = True
+                continue
+
+            self._checkin(port, conn)
+            with self._lock:
+                self._stats["requests"] += 1
+
+            if status != 200:
+                raise PandocServerError(f"pandoc server responded {status}: {data[:200]!r}")
+            try:
+                return _output(data)
+            except (ValueError, KeyError) as e:
+                raise PandocServerError(f"invalid response from pandoc server: {data[:200]!r}") from e
+
+    def stats(self) -> dict[str, int]:
+        """
+        Return the counters: ``launches``, ``restarts``, ``requests``, ``errors`` and ``connections`` opened.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def stop(self) -> None:
+        """Stop the server and close the idle connections. It is launched again by the next conversion."""
+
+        with self._lock:
+            self._close_idle()
+            self._terminate()
+
+    def __enter__(self) -> PandocServer:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def _ensure_running(self) -> None:
+        if self._failed:
+            raise PandocServerError("pandoc server is not available")
+
+        if self._proc is not None:
+            if self._proc.poll() is None:
+                return
+
+            logger.warning("pandoc server exited with %s, relaunch it", self._proc.returncode)
+            self._close_idle()
+            self._proc = None
+            if self._stats["restarts"] >= self.max_restarts:
+                self._fail(f"pandoc server died more than {self.max_restarts} times")
+            self._stats["restarts"] += 1
+
+        try:
+            self._launch()
+        except PandocServerError as e:
+            self._terminate()
+            self._fail(str(e))
+
+    def _launch(self) -> None:
+        import http.client
+
+        # The port is free when it is found, and very likely still free when the server binds it.
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+
+        cmd = [*self.command, "--port", str(port), "--timeout", str(max(round(self.timeout), 1))]
+        try:
+            self._proc = subprocess.Popen(
+                cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+        except OSError as e:
+            raise PandocServerError(f"failed to launch {cmd}: {e!r}") from e
+
+        self._port = port
+        self._stats["launches"] += 1
+        logger.warning(
+            "pandoc server listens on port %d of all network interfaces without authentication,"
+            " use it only on a trusted network",
+            port,
+        )
+        if not self._atexit:
+            atexit.register(self.stop)
+            self._atexit = True
+
+        deadline = time.monotonic() + self.start_timeout
+        while True:
+            if self._proc.poll() is not None:
+                raise PandocServerError(f"{cmd} exited with {self._proc.returncode}")
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise PandocServerError(f"{cmd} does not accept connections in {self.start_timeout} seconds")
+                time.sleep(0.02)
+
+        # A server may listen but fail to convert, e.g. a pandoc built without a threaded runtime.
+        conn = self._connect(port)
+        try:
+            conn.request(
+                "POST",
+                "/",
+                body=b'{"from": "markdown", "to": "html", "text": "k3down2"}',
+                headers={"Content-Type": "application/json", "Accept": "application/json"},
+            )
+            resp = conn.getresponse()
+            status, data = resp.status, resp.read()
+            if status != 200 or "k3down2" not in _output(data):
+                raise PandocServerError(f"pandoc server failed to convert: {status} {data[:200]!r}")
+        except (OSError, http.client.HTTPException, ValueError, KeyError) as e:
+            conn.close()
+            raise PandocServerError(f"pandoc server failed to convert: {e!r}") from e
+        self._idle.put((port, conn))
+
+    def _fail(self, reason: str) -> None:
+        self._failed = True
+        logger.warning("%s, pandoc server is disabled", reason)
+        raise PandocServerError(reason)
+
+    def _terminate(self) -> None:
+        proc, self._proc = self._proc, None
+        if proc is None or proc.poll() is not None:
+            return
+        proc.terminate()
+        try:
+            proc.wait(5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+    def _connect(self, port: int) -> http.client.HTTPConnection:
+        import http.client
+
+        self._stats["connections"] += 1
+        return http.client.HTTPConnection("127.0.0.1", port, timeout=self.timeout + 5)
+
+    def _checkout(self, port: int) -> http.client.HTTPConnection:
+        while True:
+            try:
+                conn_port, conn = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    return self._connect(port)
+            if conn_port == port:
+                return conn
+            # Connected to a server that is gone.
+            conn.close()
+
+    def _checkin(self, port: int, conn: http.client.HTTPConnection) -> None:
+        if port == self._port and self._idle.qsize() < self.pool_size:
+            self._idle.put((port, conn))
+        else:
+            conn.close()
+
+    def _close_idle(self) -> None:
+        while True:
+            try:
+                _, conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+
+
+def _output(data: bytes) -> str:
+    """Extract the output from a json response of ``pandoc server``."""
+
+    resp = json.loads(data)
+    output = resp["output"]
+    if resp.get("base64"):
+        output = base64.b64decode(output).decode("utf-8")
+
+    # The command prints a newline after the output, the server does not.
+    if not output.endswith("\n"):
+        output += "\n"
+    return output
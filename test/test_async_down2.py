@@ -0,0 +1,160 @@
+import asyncio
+import io
+import os
+import tempfile
+import unittest
+
+import k3down2
+from k3down2 import async_down2, down2
+from PIL import Image as PILImage
+
+from .test_down2 import cmp_image, fread, fwrite, rm
+
+
+class TestAsync(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await k3down2.async_shutdown()
+
+    async def test_async_render_to_img(self):
+        d = "test/data/render_to_img"
+
+        cases = [
+            ("html", "png", {}),
+            ("svg", "jpg", {}),
+            ("html-code", "png", {}),
+            ("html-code-500", "png", {"width": 500}),
+        ]
+
+        got = await asyncio.gather(
+            *[
+                k3down2.async_render_to_img(frm.split("-")[0], fread(d, frm, "input"), to, **opts)
+                for frm, to, opts in cases
+            ]
+        )
+
+        for (frm, to, _), data in zip(cases, got):
+            gotfn = "got." + to
+            fwrite(d, frm, gotfn, data)
+
+            sim = cmp_image(os.path.join(d, frm, "want." + to), os.path.join(d, frm, gotfn))
+            self.assertGreater(sim, 0.75)
+
+            rm(d, frm, gotfn)
+
+    async def test_async_convert(self):
+        d = "test/data/convert"
+
+        cases = [
+            ("code", "jpg", {}),
+            ("code-500", "jpg", {"width": 500}),
+            ("table", "png", {}),
+            ("md", "png", {}),
+        ]
+
+        got = await asyncio.gather(
+            *[
+                k3down2.async_convert(folder.split("-")[0], fread(d, folder, "input"), to, opt={"html": opts})
+                for folder, to, opts in cases
+            ]
+        )
+
+        for (folder, to, _), data in zip(cases, got):
+            gotpath = os.path.join(d, folder, "got." + to)
+            fwrite(gotpath, data)
+
+            sim = cmp_image(os.path.join(d, folder, "want." + to), gotpath)
+            self.assertGreater(sim, 0.75)
+
+            rm(gotpath)
+
+    async def test_async_convert_opt(self):
+        d = "test/data/convert"
+        info = {}
+
+        got = await k3down2.async_convert(
+            "code", fread(d, "code", "input"), "png", opt={"html": {"clip": True, "target_width": 300, "info": info}}
+        )
+        self.assertEqual((300, info["height"]), PILImage.open(io.BytesIO(got)).size)
+        self.assertEqual(300, info["width"])
+
+    async def test_async_convert_like_convert(self):
+        k3down2.register_converter("k3test", "upper", lambda x, suffix="": x.upper() + suffix)
+        calls = []
+        k3down2.register_converter("upper", "k3out", lambda x: calls.append(x) or x.encode() + b"!")
+        tdir = tempfile.TemporaryDirectory()
+        down2.set_result_cache(k3down2.ResultCache(tdir.name))
+        try:
+            stages = []
+            opt = {"k3test": {"suffix": "?"}}
+            got = await k3down2.async_convert(
+                "k3test", "a", "k3out", opt=opt, hook=lambda *args: stages.append(args[:2])
+            )
+            self.assertEqual(b"A?!", got)
+            self.assertEqual(
+                [
+                    ("start", "convert.cache"),
+                    ("end", "convert.cache"),
+                    ("start", "convert.k3test->upper"),
+                    ("end", "convert.k3test->upper"),
+                    ("start", "convert.upper->k3out"),
+                    ("end", "convert.upper->k3out"),
+                ],
+                stages,
+            )
+
+            # Cached by either of them.
+            self.assertEqual(b"A?!", k3down2.convert("k3test", "a", "k3out", opt=opt))
+            buf = io.BytesIO()
+            self.assertIsNone(await k3down2.async_convert("k3test", "a", "k3out", opt=opt, out=buf))
+            self.assertEqual(b"A?!", buf.getvalue())
+            self.assertEqual(["A?"], calls)
+        finally:
+            down2.set_result_cache(None)
+            tdir.cleanup()
+            for k in [("k3test", "upper"), ("upper", "k3out")]:
+                del down2.mappings[k]
+
+    async def test_async_convert_without_browser(self):
+        got = await k3down2.async_convert("tex_inline", r"a_1 + b^2", "plain")
+        self.assertEqual("a₁ + b²", got)
+
+        with self.assertRaises(ValueError):
+            await k3down2.async_convert("tex_inline", "a", "foo")
+
+        # Options are checked before rendering, like ``render_to_img`` does.
+        with self.assertRaises(ValueError):
+            await k3down2.async_convert("html", "a", "png", opt={"html": {"max_bytes": 1000}})
+
+        # A converter replaced in the registry is used instead of rendering.
+        builtin = down2.mappings[("html", "png")]
+        k3down2.register_converter("html", "png", lambda x, **kwargs: b"png:" + x.encode())
+        try:
+            self.assertEqual(b"png:a", await k3down2.async_convert("html", "a", "png"))
+        finally:
+            down2.mappings[("html", "png")] = builtin
+
+
+class TestAsyncBrowserPerLoop(unittest.TestCase):
+    def test_closed_at_loop_shutdown(self):
+        closed = []
+
+        class StandIn:
+            def __init__(self, name):
+                self.name = name
+
+            async def close(self):
+                closed.append(self.name)
+
+            async def stop(self):
+                closed.append(self.name)
+
+        async def render():
+            inst = await async_down2._instance()
+            self.assertIs(inst, await async_down2._instance())
+            inst["playwright"], inst["browser"] = StandIn("playwright"), StandIn("browser")
+
+        # Every loop has its own, closed when the loop ends.
+        asyncio.run(render())
+        self.assertEqual(["browser", "playwright"], closed)
+        asyncio.run(render())
+        self.assertEqual(["browser", "playwright"] * 2, closed)
@@ -0,0 +1,174 @@
+import concurrent.futures
+import multiprocessing
+import os
+import pickle
+import tempfile
+import unittest
+
+import k3down2
+from k3down2 import down2
+
+
+def _put_and_get(directory, i):
+    cache = k3down2.ResultCache(directory, disk_size=1 << 20)
+    key = "%064x" % (i % 4)
+    value = bytes([i % 4]) * 10000
+    cache.put(key, value)
+    got = cache.get(key)
+    # Another process may have just evicted it, but never leaves a partial one.
+    return got is None or got == value
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.d = self.tdir.name
+
+    def tearDown(self):
+        down2.set_result_cache(None)
+        self.tdir.cleanup()
+
+    def test_memory_lru(self):
+        cache = k3down2.ResultCache(memory_size=25)
+
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", b"0123456789")
+        cache.put("b", "0123456789")
+        self.assertEqual(b"0123456789", cache.get("a"))
+
+        # "b" is the least recently used
+        cache.put("c", b"0123456789")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(b"0123456789", cache.get("a"))
+
+        # Too big to keep in memory
+        cache.put("d", b"x" * 26)
+        self.assertIsNone(cache.get("d"))
+
+        st = cache.stats()
+        self.assertEqual(2, st["memory_hits"])
+        self.assertEqual(3, st["misses"])
+        self.assertEqual(4, st["stores"])
+        self.assertEqual(1, st["memory_evictions"])
+        self.assertEqual(2, st["memory_items"])
+        self.assertEqual(20, st["memory_bytes"])
+
+    def test_disk(self):
+        cache = k3down2.ResultCache(self.d)
+        cache.put("ab" + "0" * 62, "text")
+        cache.put("cd" + "0" * 62, b"\x89PNG")
+
+        # Another process, or the next run.
+        cache = k3down2.ResultCache(self.d)
+        self.assertEqual("text", cache.get("ab" + "0" * 62))
+        self.assertEqual(b"\x89PNG", cache.get("cd" + "0" * 62))
+        self.assertEqual(2, cache.stats()["disk_hits"])
+
+        # Then found in memory
+        self.assertEqual("text", cache.get("ab" + "0" * 62))
+        self.assertEqual(1, cache.stats()["memory_hits"])
+
+        cache.clear()
+        self.assertIsNone(cache.get("ab" + "0" * 62))
+        self.assertIsNone(k3down2.ResultCache(self.d).get("ab" + "0" * 62))
+
+    def test_disk_eviction(self):
+        cache = k3down2.ResultCache(self.d, memory_size=0, disk_size=10000)
+
+        for i in range(10):
+            key = "%064x" % i
+            cache.put(key, bytes(2000))
+            path = os.path.join(self.d, key[:2], key)
+            # Older entries are used earlier.
+            os.utime(path, (i, i))
+
+        total = sum(os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(self.d) for f in fs)
+        self.assertLessEqual(total, 10000)
+        self.assertIsNone(cache.get("%064x" % 0))
+        self.assertEqual(bytes(2000), cache.get("%064x" % 9))
+        self.assertGreater(cache.stats()["disk_evictions"], 0)
+
+    def test_multiprocess(self):
+        ctx = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(4, mp_context=ctx) as pool:
+            got = list(pool.map(_put_and_get, [self.d] * 40, range(40)))
+        self.assertTrue(all(got))
+
+        leftover = [f for _, _, fs in os.walk(self.d) for f in fs if f.startswith(".")]
+        self.assertEqual([], leftover)
+
+    def test_pickle(self):
+        cache = k3down2.ResultCache(self.d, memory_size=100, disk_size=1000)
+        cache.put("ab" + "0" * 62, b"x")
+
+        got = pickle.loads(pickle.dumps(cache))
+        self.assertEqual((self.d, 100, 1000), (got.directory, got.memory_size, got.disk_size))
+        self.assertEqual(0, got.stats()["memory_items"])
+        self.assertEqual(b"x", got.get("ab" + "0" * 62))
+
+    def test_convert(self):
+        calls = []
+
+        def upper(x, suffix=""):
+            calls.append(x)
+            return x.upper() + suffix
+
+        k3down2.register_converter("k3test", "upper", upper)
+        try:
+            cache = k3down2.ResultCache(self.d)
+            down2.set_result_cache(cache)
+
+            self.assertEqual("ABC", k3down2.convert("k3test", "abc", "upper"))
+            self.assertEqual("ABC", k3down2.convert("k3test", "abc", "upper"))
+            self.assertEqual(["abc"], calls)
+
+            # Options are a part of the key
+            self.assertEqual("ABC!", k3down2.convert("k3test", "abc", "upper", opt={"k3test": {"suffix": "!"}}))
+            self.assertEqual("ABC!", k3down2.convert("k3test", "abc", "upper", opt={"k3test": {"suffix": "!"}}))
+            self.assertEqual(["abc", "abc"], calls)
+
+            plan = k3down2.compile_plan("k3test", "upper")
+            self.assertEqual("ABC", plan("abc"))
+            self.assertEqual(["abc", "abc"], calls)
+
+            st = cache.stats()
+            self.assertEqual(3, st["memory_hits"])
+            self.assertEqual(2, st["misses"])
+
+            down2.set_result_cache(None)
+            self.assertEqual("ABC", k3down2.convert("k3test", "abc", "upper"))
+            self.assertEqual(["abc", "abc", "abc"], calls)
+        finally:
+            del down2.mappings[("k3test", "upper")]
+
+    def test_replaced_converter(self):
+        def old(x):
+            return "old:" + x
+
+        def new(x):
+            return "new:" + x
+
+        down2.set_result_cache(k3down2.ResultCache(self.d))
+        try:
+            k3down2.register_converter("k3test", "k3out", old)
+            self.assertEqual("old:x", k3down2.convert("k3test", "x", "k3out"))
+
+            k3down2.register_converter("k3test", "k3out", new)
+            self.assertEqual("new:x", k3down2.convert("k3test", "x", "k3out"))
+
+            # Lambdas defined at the same place, with different code.
+            k3down2.register_converter("k3test", "k3out", lambda x: "a:" + x)
+            self.assertEqual("a:x", k3down2.convert("k3test", "x", "k3out"))
+            k3down2.register_converter("k3test", "k3out", lambda x: "b:" + x)
+            self.assertEqual("b:x", k3down2.convert("k3test", "x", "k3out"))
+
+            # Results that change without a change of code are told apart by the version.
+            state = {"prefix": "v1:"}
+            k3down2.register_converter("k3test", "k3out", lambda x: state["prefix"] + x, version="1")
+            self.assertEqual("v1:x", k3down2.convert("k3test", "x", "k3out"))
+            state["prefix"] = "v2:"
+            self.assertEqual("v1:x", k3down2.convert("k3test", "x", "k3out"))
+            k3down2.register_converter("k3test", "k3out", lambda x: state["prefix"] + x, version="2")
+            self.assertEqual("v2:x", k3down2.convert("k3test", "x", "k3out"))
+        finally:
+            del down2.mappings[("k3test", "k3out")]
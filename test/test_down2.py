@@ -1,14 +1,22 @@
+import concurrent.futures
+import io
 import os
+import pathlib
 import re
+import subprocess
+import sys
 import unittest
 
 import numpy
 import k3ut
+from PIL import Image as PILImage
+from PIL import ImageDraw, features
 import skimage
 import skimage.io
 from skimage.metrics import structural_similarity as ssim
 
 import k3down2
+from k3down2 import down2
 
 dd = k3ut.dd
 
@@ -128,6 +136,20 @@ class TestTex(unittest.TestCase):
 
             rm(gotpath)
 
+    def test_import_is_lazy(self):
+        # Heavy dependencies must not be loaded by ``import k3down2``
+        code = "import sys, k3down2; print(' '.join(m for m in {!r} if m in sys.modules))".format(
+            ("PIL", "playwright", "pygments", "pylatexenc", "asyncio", "importlib.metadata")
+        )
+        out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+        self.assertEqual("", out.strip())
+
+    def test_warmup(self):
+        k3down2.warmup(pages=2, lexers=("go", "python"))
+        self.assertGreaterEqual(k3down2.page_pool_stats()["idle"], 2)
+
+        self.assertRaises(ValueError, k3down2.warmup, browser=False, tools=("foo",))
+
     def test_tex_to_zhihu_compatible(self):
         tex = r"\{ q > 5, a <> 2 \}"
         want = r"\{ q \gt 5, a <\gt 2 \}"
@@ -302,6 +324,409 @@ X = \begin{bmatrix}
 
             rm(d, frm, gotfn)
 
+    def test_trim_bbox(self):
+        for mode, bg, near, far in (
+            ("RGBA", (0, 0, 0, 0), (0, 0, 0, 5), (10, 20, 30, 255)),
+            ("RGBA", (255, 255, 255, 255), (250, 250, 250, 255), (0, 0, 0, 255)),
+            ("RGB", (255, 255, 255), (250, 250, 250), (0, 0, 0)),
+        ):
+            img = PILImage.new(mode, (50, 40), bg)
+            self.assertIsNone(down2._trim_bbox(img), mode)
+
+            img.putpixel((7, 9), far)
+            img.putpixel((30, 20), far)
+            img.putpixel((2, 1), near)
+            img.putpixel((45, 35), near)
+
+            self.assertEqual((2, 1, 46, 36), down2._trim_bbox(img), mode)
+            self.assertEqual((7, 9, 31, 21), down2._trim_bbox(img, tolerance=8), mode)
+
+    def test_png_profile(self):
+        img = PILImage.new("RGBA", (400, 300), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        for i in range(10):
+            draw.rectangle((5, i * 25, 395, i * 25 + 22), fill=(240, 240, 250, 255), outline=(0, 0, 0, 255))
+            draw.text((10, i * 25 + 5), "cell %d | text" % i, fill=(30, 30, 30, 255))
+        buf = io.BytesIO()
+        img.save(buf, format="PNG", icc_profile=b"not really a profile")
+        png = buf.getvalue()
+
+        dflt = down2._trim_and_convert(png, "png")
+        small = down2._trim_and_convert(png, "png", png_profile="small")
+        self.assertLess(len(small), len(dflt))
+
+        got = PILImage.open(io.BytesIO(small))
+        self.assertEqual("P", got.mode)
+        self.assertEqual((391, 248), got.size)
+        self.assertNotIn("icc_profile", got.info)
+        self.assertIn("icc_profile", PILImage.open(io.BytesIO(dflt)).info)
+
+        got = PILImage.open(io.BytesIO(down2._trim_and_convert(png, "png", png_profile={"compress_level": 0})))
+        self.assertEqual("RGBA", got.mode)
+
+        for invalid in ("tiny", {"colours": 16}, {"colors": 1000}, {"compress_level": 10}):
+            with self.assertRaises(ValueError):
+                down2._trim_and_convert(png, "png", png_profile=invalid)
+
+    def test_trim_and_convert_webp_avif(self):
+        img = PILImage.new("RGBA", (60, 40), (0, 0, 0, 0))
+        for x in range(10, 50):
+            img.putpixel((x, 20), (200, 0, 0, 255))
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+        png = buf.getvalue()
+
+        typs = ["webp"]
+        if features.check("avif"):
+            typs.append("avif")
+
+        for typ in typs:
+            for lossless in (False, True):
+                data = down2._trim_and_convert(png, typ, lossless=lossless)
+                got = PILImage.open(io.BytesIO(data))
+                self.assertEqual(typ.upper(), got.format)
+                self.assertEqual((40, 1), got.size)
+
+            got = PILImage.open(io.BytesIO(down2._trim_and_convert(png, typ, trim=False, lossless=True)))
+            got = got.convert("RGBA")
+            for want, pix in zip((200, 0, 0, 255), got.getpixel((30, 20))):
+                self.assertLessEqual(abs(want - pix), 1, typ)
+            self.assertEqual(0, got.getpixel((0, 0))[3])
+
+        for frm in ("html", "table", "code", "md", "mermaid", "graphviz", "tex_block", "tex_inline", "svg"):
+            for to in ("webp", "avif"):
+                self.assertEqual(to, k3down2.conversion_route(frm, to)[-1].output_typ)
+
+    def test_trim_and_convert_max_bytes(self):
+        # Noise compresses badly.
+        pixels = (numpy.random.default_rng(0).random((300, 400, 3)) * 255).astype("uint8")
+        buf = io.BytesIO()
+        PILImage.fromarray(pixels).save(buf, format="PNG")
+        png = buf.getvalue()
+
+        full = down2._trim_and_convert(png, "jpg", trim=False, quality=80)
+
+        info = {}
+        data = down2._trim_and_convert(png, "jpg", trim=False, quality=80, max_bytes=len(full), info=info)
+        self.assertEqual(full, data)
+        self.assertEqual(80, info["quality"])
+
+        budget = len(full) // 2
+        info = {}
+        data = down2._trim_and_convert(png, "jpg", trim=False, quality=80, max_bytes=budget, info=info)
+        self.assertLessEqual(len(data), budget)
+        self.assertLess(info["quality"], 80)
+        self.assertEqual((400, 300), (info["width"], info["height"]))
+
+        # Quality one higher does not fit.
+        higher = down2._trim_and_convert(png, "jpg", trim=False, quality=info["quality"] + 1)
+        self.assertGreater(len(higher), budget)
+
+        with self.assertRaises(ValueError):
+            down2._trim_and_convert(png, "jpg", trim=False, max_bytes=5000)
+
+        info = {}
+        data = down2._trim_and_convert(png, "jpg", trim=False, max_bytes=5000, downscale=True, info=info)
+        self.assertLessEqual(len(data), 5000)
+        self.assertEqual((info["width"], info["height"]), PILImage.open(io.BytesIO(data)).size)
+        self.assertLess(info["width"], 400)
+
+    def test_scale_for_width(self):
+        self.assertEqual(1, down2._scale_for_width(300, 300))
+        self.assertEqual(0.5, down2._scale_for_width(150, 300))
+        self.assertEqual(0.375, down2._scale_for_width(100, 300))
+        self.assertEqual(2.125, down2._scale_for_width(620, 300))
+        self.assertEqual(0.125, down2._scale_for_width(1, 300))
+        self.assertEqual(1, down2._scale_for_width(100, 0))
+
+    def test_render_to_img_scale(self):
+        d = "test/data/render_to_img"
+        inp = fread(d, "html", "input")
+
+        info2 = {}
+        k3down2.render_to_img("html", inp, "png", info=info2)
+        self.assertEqual(2, info2["scale"])
+
+        info1 = {}
+        k3down2.render_to_img("html", inp, "png", scale=1, info=info1)
+        self.assertEqual(1, info1["scale"])
+        self.assertAlmostEqual(info2["width"] / 2, info1["width"], delta=2)
+
+        for to in ("png", "jpg"):
+            info = {}
+            data = k3down2.render_to_img("html", inp, to, target_width=300, clip=True, info=info)
+            self.assertEqual(300, info["width"])
+            self.assertEqual(300, PILImage.open(io.BytesIO(data)).width)
+
+        with self.assertRaises(ValueError):
+            k3down2.render_to_img("html", inp, "png", scale=0)
+        with self.assertRaises(ValueError):
+            k3down2.render_to_img("html", inp, "png", target_width=0)
+
+    def test_document_served_after_load(self):
+        assets = os.path.abspath("test/data/md_to_html/assets")
+
+        def fetch_after_load():
+            with down2._checkout_page(100, 100) as page:
+                down2._load_document(page, "text/html", "<p>a</p>", "html", assets)
+                # Requested after loading, e.g. by a lazy image or a script.
+                got = page.evaluate("Promise.all(['foo.jpg', 'index.html'].map(u => fetch(u).then(r => r.status)))")
+            return got, down2._page_documents.get(page)
+
+        statuses, doc = down2._in_render_thread(down2._render, fetch_after_load)
+        self.assertEqual([200, 200], statuses)
+        # Not served any more once the page is back in the pool.
+        self.assertIn(doc, ({}, None))
+
+    def test_render_to_img_via_file(self):
+        d = "test/data/render_to_img"
+
+        for frm, to in [
+            ("html", "png"),
+            ("svg", "jpg"),
+        ]:
+            gotfn = "got." + to
+            inp = fread(d, frm, "input")
+
+            data = k3down2.render_to_img(frm, inp, to, via_file=True)
+            fwrite(d, frm, gotfn, data)
+
+            sim = cmp_image(os.path.join(d, frm, "want." + to), os.path.join(d, frm, gotfn))
+            self.assertGreater(sim, 0.75)
+
+            rm(d, frm, gotfn)
+
+    def test_render_to_img_clip(self):
+        d = "test/data/render_to_img"
+
+        for frm, to, opts in [
+            ("html", "png", {}),
+            ("svg", "jpg", {}),
+            ("html-code", "png", {}),
+            ("html-code-500", "png", {"width": 500}),
+        ]:
+            frm_typ = frm.split("-")[0]
+            gotfn = "got." + to
+
+            inp = fread(d, frm, "input")
+
+            data = k3down2.render_to_img(frm_typ, inp, to, clip=True, **opts)
+            fwrite(d, frm, gotfn, data)
+
+            sim = cmp_image(os.path.join(d, frm, "want." + to), os.path.join(d, frm, gotfn))
+            self.assertGreater(sim, 0.75)
+
+            rm(d, frm, gotfn)
+
+        # Nothing painted, fall back to trimming
+        data = k3down2.render_to_img("html", "<p> </p>", "png", clip=True)
+        self.assertTrue(data.startswith(b"\x89PNG"))
+
+    def test_render_to_img_clip_jpeg(self):
+        d = "test/data/render_to_img"
+        inp = fread(d, "svg", "input")
+
+        info = {}
+        data = k3down2.render_to_img("svg", inp, "jpg", clip=True, quality=90, info=info)
+        self.assertTrue(data.startswith(b"\xff\xd8"))
+        self.assertGreater(info["width"], 0)
+        self.assertGreater(info["height"], 0)
+
+        fwrite(d, "svg", "got.jpg", data)
+        sim = cmp_image(os.path.join(d, "svg", "want.jpg"), os.path.join(d, "svg", "got.jpg"))
+        self.assertGreater(sim, 0.75)
+        rm(d, "svg", "got.jpg")
+
+        low = k3down2.render_to_img("svg", inp, "jpg", clip=True, quality=10)
+        self.assertLess(len(low), len(data))
+
+    def test_render_to_img_full_page(self):
+        d = "test/data/render_to_img"
+
+        for frm, to, opts in [
+            ("html", "png", {}),
+            ("html-code", "png", {}),
+            # content taller than the window
+            ("html-code-300", "png", {"width": 300, "height": 100}),
+        ]:
+            frm_typ = frm.split("-")[0]
+            gotfn = "got." + to
+
+            inp = fread(d, frm, "input")
+
+            info = {}
+            data = k3down2.render_to_img(frm_typ, inp, to, full_page=True, info=info, **opts)
+            fwrite(d, frm, gotfn, data)
+
+            with PILImage.open(os.path.join(d, frm, gotfn)) as img:
+                self.assertEqual({"width": img.size[0], "height": img.size[1], "scale": 2}, info)
+
+            sim = cmp_image(os.path.join(d, frm, "want." + to), os.path.join(d, frm, gotfn))
+            self.assertGreater(sim, 0.75)
+
+            rm(d, frm, gotfn)
+
+    def test_render_many(self):
+        d = "test/data/render_to_img"
+
+        folders = ["html", "html-code", "html"]
+        inputs = [fread(d, frm, "input") for frm in folders]
+
+        got = k3down2.render_many("html", inputs, "png")
+        self.assertEqual(len(folders), len(got))
+
+        for frm, data in zip(folders, got):
+            fwrite(d, frm, "got.png", data)
+
+            sim = cmp_image(os.path.join(d, frm, "want.png"), os.path.join(d, frm, "got.png"))
+            self.assertGreater(sim, 0.75)
+
+            rm(d, frm, "got.png")
+
+        got = k3down2.render_many("svg", [fread(d, "svg", "input")], "jpg")
+        fwrite(d, "svg", "got.jpg", got[0])
+
+        sim = cmp_image(os.path.join(d, "svg", "want.jpg"), os.path.join(d, "svg", "got.jpg"))
+        self.assertGreater(sim, 0.75)
+
+        rm(d, "svg", "got.jpg")
+
+        self.assertEqual([], k3down2.render_many("html", [], "png"))
+
+    def test_convert_in_threads(self):
+        d = "test/data/convert"
+
+        folders = ["code", "table", "md", "code", "table", "md"]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(k3down2.convert, f, fread(d, f, "input"), "png") for f in folders]
+            got = [f.result() for f in futures]
+
+        for folder, data in zip(folders, got):
+            gotpath = pjoin(d, folder, "got.png")
+            fwrite(gotpath, data)
+
+            sim = cmp_image(pjoin(d, folder, "want.png"), gotpath)
+            self.assertGreater(sim, 0.75)
+
+            rm(gotpath)
+
+    def test_page_pool_stats_in_threads(self):
+        keys = [(i, 1, 1.0) for i in range(1, 200001)]
+
+        def grow():
+            # Like the renders adding pages of new viewports to the pool.
+            for k in keys:
+                down2._page_pool.setdefault(k, [])
+
+        def shrink():
+            for k in keys:
+                down2._page_pool.pop(k, None)
+
+        with concurrent.futures.ThreadPoolExecutor(1) as pool:
+            fut = pool.submit(down2._in_render_thread, grow)
+            while not fut.done():
+                self.assertGreaterEqual(k3down2.page_pool_stats()["idle"], 0)
+            fut.result()
+        down2._in_render_thread(shrink)
+
+    def test_render_to_img_page_pool(self):
+        d = "test/data/render_to_img"
+        inp = fread(d, "html", "input")
+
+        k3down2.render_to_img("html", inp, "png")
+        before = k3down2.page_pool_stats()
+        self.assertGreaterEqual(before["idle"], 1)
+
+        k3down2.render_to_img("html", inp, "png")
+        after = k3down2.page_pool_stats()
+        self.assertEqual(before["reused"] + 1, after["reused"])
+        self.assertEqual(before["created"], after["created"])
+
+        k3down2.set_page_pool_size(0)
+        try:
+            self.assertEqual(0, k3down2.page_pool_stats()["idle"])
+
+            k3down2.render_to_img("html", inp, "png")
+            self.assertEqual(0, k3down2.page_pool_stats()["idle"])
+        finally:
+            k3down2.set_page_pool_size(8)
+
+        self.assertRaises(ValueError, k3down2.set_page_pool_size, -1)
+
+    def test_browser_recycle(self):
+        inp = fread("test/data/render_to_img", "html", "input")
+
+        k3down2.set_browser_recycle(max_renders=2)
+        try:
+            before = k3down2.browser_stats()
+            for _ in range(5):
+                k3down2.render_to_img("html", inp, "png")
+            after = k3down2.browser_stats()
+        finally:
+            k3down2.set_browser_recycle()
+
+        self.assertEqual(before["renders"] + 5, after["renders"])
+        self.assertGreaterEqual(after["recycles"] - before["recycles"], 2)
+        self.assertLessEqual(after["renders_since_launch"], 2)
+
+        self.assertRaises(ValueError, k3down2.set_browser_recycle, max_renders=-1)
+
+    def test_browser_crash_recovery(self):
+        inp = fread("test/data/render_to_img", "html", "input")
+        k3down2.render_to_img("html", inp, "png")
+
+        # Simulate a crashed browser, with pages in the pool belonging to it.
+        before = k3down2.browser_stats()
+        down2._in_render_thread(down2._browser.close)
+
+        data = k3down2.render_to_img("html", inp, "png")
+        self.assertTrue(data.startswith(b"\x89PNG"))
+
+        after = k3down2.browser_stats()
+        self.assertEqual(before["restarts"] + 1, after["restarts"])
+        self.assertEqual(before["launches"] + 1, after["launches"])
+
+    def test_browser_stats(self):
+        st = k3down2.browser_stats()
+        for k in ("launches", "restarts", "recycles", "renders", "renders_since_launch"):
+            self.assertGreaterEqual(st[k], 0, k)
+
+        if st["rss"] is not None:
+            self.assertGreater(st["rss"], 0)
+
+    def test_driver_pid(self):
+        # Fails if an upgrade of playwright breaks the way to find the driver process.
+        down2._in_render_thread(down2._get_playwright)
+        pid = down2._driver_pid()
+        self.assertIsInstance(pid, int)
+        if os.path.isdir("/proc"):
+            self.assertGreater(down2._browser_rss(), 0)
+
+        driver_pid = down2._driver_pid
+        down2._driver_pid = lambda: None
+        try:
+            with self.assertLogs("k3down2.down2", level="WARNING"):
+                self.assertFalse(down2._rss_exceeds(1))
+        finally:
+            down2._driver_pid = driver_pid
+            down2._rss_unknown_warned = False
+
+    def test_process_tree_rss(self):
+        if not os.path.isdir("/proc"):
+            self.skipTest("requires /proc")
+
+        # Only the process and its descendants are counted, not the siblings such as the browser or pandoc.
+        p = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)"])
+        try:
+            child = down2._process_tree_rss(p.pid)
+            self.assertGreater(child, 0)
+            self.assertGreater(down2._process_tree_rss(os.getpid()), child)
+        finally:
+            p.kill()
+            p.wait()
+
+        self.assertIsNone(down2._process_tree_rss(p.pid))
+
     def test_download(self):
         url = "https://www.zhihu.com/equation?tex=a%20%3D%20b%5C%5C"
 
@@ -311,6 +736,292 @@ X = \begin{bmatrix}
             want = f.read()
         self.assertEqual(want, data)
 
+    def test_compile_plan(self):
+        plan = k3down2.compile_plan("tex_inline", "png")
+        self.assertEqual(["tex_inline", "url", "svg", "png"], plan.route)
+
+        with self.assertRaises(ValueError):
+            k3down2.compile_plan("tex_inline", "foo")
+
+        down2.mappings[("k3test", "upper")] = lambda x, suffix="": x.upper() + suffix
+        down2.mappings[("upper", "reversed")] = lambda x: x[::-1]
+        down2.mappings[("k3test", "reversed")] = "upper"
+        try:
+            plan = k3down2.compile_plan("k3test", "reversed", {"k3test": {"suffix": "!"}})
+            self.assertEqual(["k3test", "upper", "reversed"], plan.route)
+            self.assertEqual("!CBA", plan("abc"))
+            self.assertEqual("!FED", plan("def"))
+
+            self.assertEqual("CBA", k3down2.convert("k3test", "abc", "reversed"))
+
+            # convert() sees changes of mappings
+            down2.mappings[("upper", "reversed")] = lambda x: x + x
+            self.assertEqual("ABCABC", k3down2.convert("k3test", "abc", "reversed"))
+
+            down2.mappings[("upper", "k3test")] = "reversed"
+            down2.mappings[("reversed", "k3test")] = "upper"
+            with self.assertRaises(ValueError):
+                k3down2.compile_plan("upper", "k3test")
+        finally:
+            for k in list(down2.mappings):
+                if "k3test" in k or k == ("upper", "reversed"):
+                    del down2.mappings[k]
+
+    def test_convert_plan_cache(self):
+        down2.mappings[("k3test", "upper")] = lambda x, suffix="", info=None: x.upper() + suffix
+        try:
+            opt = {"k3test": {"suffix": "!"}}
+            self.assertEqual("ABC!", k3down2.convert("k3test", "abc", "upper", opt=opt))
+            plan = down2._plan_cache[down2._plan_key("k3test", "upper", opt)]
+            self.assertEqual("DEF!", k3down2.convert("k3test", "def", "upper", opt={"k3test": {"suffix": "!"}}))
+            self.assertIs(plan, down2._plan_cache[down2._plan_key("k3test", "upper", opt)])
+
+            # The cached plan is not bound to the dict of the caller.
+            opt["k3test"]["suffix"] = "?"
+            self.assertEqual("ABC?", k3down2.convert("k3test", "abc", "upper", opt=opt))
+            self.assertEqual("ABC!", k3down2.convert("k3test", "abc", "upper", opt={"k3test": {"suffix": "!"}}))
+
+            # Not reused: options that are not json, and ``info`` to fill.
+            self.assertIsNone(down2._plan_key("k3test", "upper", {"k3test": {"suffix": object()}}))
+            self.assertIsNone(down2._plan_key("k3test", "upper", {"k3test": {"info": {}}}))
+
+            for i in range(down2._plan_cache_size + 10):
+                k3down2.convert("k3test", "abc", "upper", opt={"k3test": {"suffix": str(i)}})
+            self.assertLessEqual(len(down2._plan_cache), down2._plan_cache_size)
+        finally:
+            del down2.mappings[("k3test", "upper")]
+
+    def test_conversion_route(self):
+        def route(frm, to, **kwargs):
+            convs = k3down2.conversion_route(frm, to, **kwargs)
+            return [frm] + [c.output_typ for c in convs]
+
+        # The routes of the former hard-coded table.
+        self.assertEqual(["md", "html", "png"], route("md", "png"))
+        self.assertEqual(["table", "html", "jpg"], route("table", "jpg"))
+        self.assertEqual(["code", "html", "webp"], route("code", "webp"))
+        self.assertEqual(["mermaid", "svg", "png"], route("mermaid", "png"))
+        self.assertEqual(["tex_block", "url", "svg", "jpg"], route("tex_block", "jpg"))
+        self.assertEqual(["tex_inline", "url", "svg"], route("tex_inline", "svg"))
+
+        # The indirect entries of the former table are still there.
+        self.assertEqual("html", down2.mappings[("md", "jpg")])
+        self.assertEqual("svg", down2.mappings[("tex_inline", "png")])
+
+        # dot is cheaper than svg plus a browser.
+        self.assertEqual(["graphviz", "png"], route("graphviz", "png"))
+        # Unless dot is not wanted.
+        with self.assertRaises(ValueError):
+            k3down2.conversion_route("graphviz", "png", avoid=["dot"])
+
+        # A url is downloaded as png only if the input is a url.
+        self.assertEqual(["url", "png"], route("url", "png"))
+        with self.assertRaises(ValueError):
+            k3down2.conversion_route("tex_inline", "html")
+
+        try:
+            # A cheaper backend takes over the routes through it.
+            fast = k3down2.register_converter("graphviz", "html", lambda x: "<p>" + x + "</p>", cost=1)
+            self.assertIs(fast, down2.mappings[("graphviz", "html")])
+            self.assertEqual("<p>a</p>", k3down2.convert("graphviz", "a", "html"))
+            self.assertEqual(["graphviz", "png"], route("graphviz", "png"))
+            self.assertEqual(["graphviz", "html", "png"], route("graphviz", "png", avoid=["dot"]))
+
+            plan = k3down2.compile_plan("graphviz", "png", avoid=["dot"])
+            self.assertEqual(101, plan.cost)
+        finally:
+            del down2.mappings[("graphviz", "html")]
+
+        with self.assertRaises(ValueError):
+            k3down2.register_converter("a", "b", str, cost=-1)
+
+    def test_convert_multi(self):
+        calls = []
+
+        def to_html(x, tag="p"):
+            calls.append(("html", x))
+            return "<%s>%s</%s>" % (tag, x, tag)
+
+        def to_imgs(x, typs, scale=1):
+            calls.append(("imgs", x, tuple(typs)))
+            return ["%s:%s*%d" % (typ, x, scale) for typ in typs]
+
+        k3down2.register_converter("k3test", "k3html", to_html)
+        for typ in ("k3png", "k3jpg"):
+            k3down2.register_converter(
+                "k3html", typ, lambda x, typ=typ, **kwargs: to_imgs(x, [typ], **kwargs)[0], multi_fn=to_imgs
+            )
+        try:
+            got = k3down2.convert_multi(
+                "k3test", "a", ["k3png", "k3html", "k3jpg"], opt={"k3test": {"tag": "b"}, "k3html": {"scale": 2}}
+            )
+            self.assertEqual({"k3html": "<b>a</b>", "k3png": "k3png:<b>a</b>*2", "k3jpg": "k3jpg:<b>a</b>*2"}, got)
+            self.assertEqual(["k3png", "k3html", "k3jpg"], list(got))
+            self.assertEqual([("html", "a"), ("imgs", "<b>a</b>", ("k3png", "k3jpg"))], calls)
+        finally:
+            for k in list(down2.mappings):
+                if k[0] in ("k3test", "k3html"):
+                    del down2.mappings[k]
+
+        with self.assertRaises(ValueError):
+            k3down2.convert_multi("table", "a", ["png", "foo"])
+
+    def test_convert_multi_table(self):
+        d = "test/data/convert"
+        inp = fread(d, "table", "input")
+
+        got = k3down2.convert_multi("table", inp, ["html", "png", "jpg"])
+        self.assertEqual(k3down2.convert("table", inp, "html"), got["html"])
+
+        for to in ("png", "jpg"):
+            gotpath = pjoin(d, "table", "got." + to)
+            fwrite(gotpath, got[to])
+            sim = cmp_image(pjoin(d, "table", "want." + to), gotpath)
+            self.assertGreater(sim, 0.75)
+            rm(gotpath)
+
+    def test_stage_hook(self):
+        events = []
+
+        def hook(event, stage, info):
+            events.append((event, stage, dict(info)))
+
+        def to_html(x):
+            # A nested stage, like ``render_to_img`` in a step, finds the hook of the conversion.
+            with down2._Stage(down2._current_stage_hook(), "k3test.inner"):
+                return "<p>%s</p>" % x
+
+        k3down2.register_converter("k3test", "k3html", to_html)
+        k3down2.register_converter("k3html", "k3png", lambda x: x.upper().encode())
+        try:
+            self.assertEqual(b"<P>AB</P>", k3down2.convert("k3test", "ab", "k3png", hook=hook))
+            self.assertEqual(
+                [
+                    ("start", "convert.k3test->k3html"),
+                    ("start", "k3test.inner"),
+                    ("end", "k3test.inner"),
+                    ("end", "convert.k3test->k3html"),
+                    ("start", "convert.k3html->k3png"),
+                    ("end", "convert.k3html->k3png"),
+                ],
+                [e[:2] for e in events],
+            )
+            end = events[3][2]
+            self.assertEqual(
+                ("k3test", "k3html", 2, 9), (end["input_typ"], end["output_typ"], end["bytes_in"], end["bytes"])
+            )
+            self.assertGreaterEqual(end["duration"], 0)
+            self.assertNotIn("duration", events[0][2])
+
+            # Outside a conversion there is no hook.
+            self.assertIsNone(down2._current_stage_hook())
+
+            # A global hook, and a failing hook does not break the conversion.
+            del events[:]
+            k3down2.set_stage_hook(hook)
+            try:
+                self.assertEqual({"k3html": "<p>ab</p>"}, k3down2.convert_multi("k3test", "ab", ["k3html"]))
+                self.assertEqual(4, len(events))
+
+                def broken(event, stage, info):
+                    raise RuntimeError("broken hook")
+
+                with self.assertLogs("k3down2.down2", level="ERROR"):
+                    self.assertEqual(b"<P>AB</P>", k3down2.convert("k3test", "ab", "k3png", hook=broken))
+                self.assertEqual(4, len(events))
+            finally:
+                k3down2.set_stage_hook(None)
+
+            # A failed stage is reported with the error.
+            del events[:]
+            with self.assertRaises(AttributeError):
+                k3down2.convert("k3html", b"x", "k3png", hook=hook)
+            self.assertIsInstance(events[-1][2]["error"], AttributeError)
+        finally:
+            for k in list(down2.mappings):
+                if k[0] in ("k3test", "k3html"):
+                    del down2.mappings[k]
+
+    def test_render_to_img_stage_hook(self):
+        stages = []
+
+        def hook(event, stage, info):
+            if event == "end":
+                stages.append((stage, info.get("bytes")))
+
+        k3down2.render_to_img("html", "<p>hello</p>", "png", via_file=True, hook=hook)
+        names = [s for s, _ in stages]
+        for name in (
+            "render_to_img.page",
+            "render_to_img.write_file",
+            "render_to_img.goto",
+            "render_to_img.layout",
+            "render_to_img.screenshot",
+            "render_to_img.render",
+            "render_to_img.trim",
+            "render_to_img.encode",
+        ):
+            self.assertIn(name, names)
+        self.assertEqual("render_to_img.encode", names[-1])
+        self.assertGreater(stages[-1][1], 0)
+
+    def test_convert_path_and_out(self):
+        d = "test/data/convert"
+        src = pathlib.Path(d, "table", "input")
+        want = k3down2.convert("table", fread(d, "table", "input"), "html")
+
+        self.assertEqual(want, k3down2.convert("table", src, "html"))
+
+        buf = io.BytesIO()
+        self.assertIsNone(k3down2.convert("table", src, "html", out=buf))
+        self.assertEqual(want.encode("utf-8"), buf.getvalue())
+
+        gotpath = pjoin(d, "table", "got.html")
+        self.assertIsNone(k3down2.convert("table", src, "html", out=gotpath))
+        self.assertEqual(want, fread(gotpath))
+        rm(gotpath)
+
+    def test_graphviz_to_img_path_and_out(self):
+        d = "test/data/convert"
+        src = pathlib.Path(d, "graphviz", "input")
+        want = k3down2.graphviz_to_img(fread(d, "graphviz", "input"), "png")
+
+        self.assertEqual(want, k3down2.graphviz_to_img(src, "png"))
+
+        buf = io.BytesIO()
+        self.assertIsNone(k3down2.convert("graphviz", src, "png", out=buf))
+        self.assertEqual(want, buf.getvalue())
+
+        for to in ("png", "webp"):
+            gotpath = pjoin(d, "graphviz", "got." + to)
+            self.assertIsNone(k3down2.convert("graphviz", src, to, out=gotpath))
+            self.assertTrue(os.path.getsize(gotpath) > 0)
+            rm(gotpath)
+
+    def test_trim_and_convert_out(self):
+        buf = io.BytesIO()
+        PILImage.new("RGBA", (20, 10), (255, 0, 0, 255)).save(buf, format="PNG")
+        png = buf.getvalue()
+        want = down2._trim_and_convert(png, "jpg")
+
+        buf = io.BytesIO()
+        self.assertIsNone(down2._trim_and_convert(png, "jpg", out=buf))
+        self.assertEqual(want, buf.getvalue())
+
+        d = "test/data/render_to_img"
+        gotpath = pjoin(d, "got.jpg")
+        self.assertIsNone(down2._trim_and_convert(png, "jpg", out=gotpath))
+        with open(gotpath, "rb") as f:
+            self.assertEqual(want, f.read())
+
+        # A failed encoding leaves the existing file and no temp file.
+        with self.assertRaises(ValueError):
+            down2._trim_and_convert(png, "jpg", max_bytes=10, out=gotpath)
+        with open(gotpath, "rb") as f:
+            self.assertEqual(want, f.read())
+        self.assertEqual([], [x for x in os.listdir(d) if x.startswith(".k3down2-")])
+        rm(gotpath)
+
     def test_mdtable_to_barehtml(self):
         md = r"""
 | a   | b   | b   |b   |
@@ -385,6 +1096,65 @@ X = \begin{bmatrix}
 
         self.assertEqual(want, got)
 
+    def test_mdtable_to_barehtml_many(self):
+        tables = [fread("test/data/convert/table/input")]
+        for i in range(5):
+            tables.append("| a | b%d |\n| :-- | --: |\n| %d | %s |\n" % (i, i, "y " * 100))
+        tables.append(pathlib.Path("test/data/convert/table/input"))
+
+        got = k3down2.mdtable_to_barehtml_many(tables)
+        self.assertEqual([k3down2.mdtable_to_barehtml(t) for t in tables], got)
+        self.assertNotIn("<colgroup>", got[1])
+        self.assertNotIn("<tbody>", got[1])
+
+        self.assertEqual([], k3down2.mdtable_to_barehtml_many([]))
+
+    def test_md_to_html_many(self):
+        mds = [
+            fread("test/data/convert/md/input"),
+            "hello *world*\n\n- x\n- y\n",
+            "",
+            # Converted alone: footnotes and heading ids depend on the document.
+            "a[^1]\n\n[^1]: note\n",
+            "# title\n",
+            "# title\n",
+            # A comment that is not closed must not swallow the separator after it.
+            "<!--\nx",
+            "```python\nprint(1)\n```\n",
+            # A div that is not closed must not wrap the fragments after it.
+            "<div>\nx\n",
+            "::: note\ny\n",
+            "z\n",
+        ]
+
+        got = k3down2.md_to_html_many(mds)
+        self.assertEqual([k3down2.md_to_html(md) for md in mds], got)
+
+    def test_md_to_html_many_broken_separator(self):
+        mds = ["para %d *x*\n" % i for i in range(8)]
+        # An unclosed code fence swallows the separators up to the fence after it.
+        mds[3] = "```\ncode\n"
+        mds[6] = "```\nx\n```\n"
+        want = [k3down2.md_to_html(md) for md in mds]
+
+        calls = []
+        pandoc_to_html = down2._pandoc_to_html
+
+        def counted(md, columns=None):
+            calls.append(md)
+            return pandoc_to_html(md, columns)
+
+        down2._pandoc_to_html = counted
+        try:
+            got = k3down2.md_to_html_many(mds)
+        finally:
+            down2._pandoc_to_html = pandoc_to_html
+
+        self.assertEqual(want, got)
+        # Fragments 0-2 in a batch, 4-7 in a batch, then 3 alone.
+        self.assertEqual(3, len(calls))
+        self.assertEqual(mds[3], calls[-1])
+
     def test_md_to_html(self):
         md = r"""
 | a   | b   | b   |b   |
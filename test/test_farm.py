@@ -0,0 +1,46 @@
+import os
+import unittest
+
+import k3down2
+
+from .test_down2 import cmp_image, fread, fwrite, rm
+
+
+class TestRenderFarm(unittest.TestCase):
+    def test_map_convert(self):
+        d = "test/data/convert"
+
+        with k3down2.RenderFarm(workers=2) as farm:
+            got = farm.map_convert("table", [fread(d, "table", "input")] * 3, "png")
+            got.append(farm.convert("code", fread(d, "code", "input"), "png"))
+
+        for folder, data in zip(["table", "table", "table", "code"], got):
+            gotpath = os.path.join(d, folder, "got.png")
+            fwrite(gotpath, data)
+
+            sim = cmp_image(os.path.join(d, folder, "want.png"), gotpath)
+            self.assertGreater(sim, 0.75)
+
+            rm(gotpath)
+
+    def test_render_to_img(self):
+        d = "test/data/render_to_img"
+
+        with k3down2.RenderFarm(workers=2) as farm:
+            data = farm.render_to_img("html", fread(d, "html-code-500", "input"), "png", width=500)
+
+        fwrite(d, "html-code-500", "got.png", data)
+
+        sim = cmp_image(os.path.join(d, "html-code-500", "want.png"), os.path.join(d, "html-code-500", "got.png"))
+        self.assertGreater(sim, 0.75)
+
+        rm(d, "html-code-500", "got.png")
+
+    def test_convert_without_browser(self):
+        with k3down2.RenderFarm(workers=2) as farm:
+            got = farm.map_convert("tex_inline", [r"a_1 + b^2", r"\mathbb{Q}^3"], "plain")
+            self.assertEqual(["a₁ + b²", "ℚ³"], got)
+
+            self.assertRaises(ValueError, farm.convert, "tex_inline", "a", "foo")
+
+        self.assertRaises(ValueError, k3down2.RenderFarm, 0)
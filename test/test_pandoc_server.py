@@ -0,0 +1,104 @@
+import concurrent.futures
+import sys
+import unittest
+
+import k3down2
+from k3down2 import down2
+from k3down2.pandoc_server import PandocServerError
+
+# A stand-in of ``pandoc server``: it wraps the text in a paragraph, and reports the columns option.
+standin = r"""
+import http.server, json, sys
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        output = "<p>%s</p>" % req["text"].strip()
+        if "columns" in req:
+            output += "\n<!-- columns %d -->" % req["columns"]
+        body = json.dumps({"output": output, "base64": False, "messages": []}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+port = int(sys.argv[sys.argv.index("--port") + 1])
+http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler).serve_forever()
+"""
+
+standin_command = (sys.executable, "-c", standin)
+
+
+class TestPandocServer(unittest.TestCase):
+    def tearDown(self):
+        k3down2.set_pandoc_backend("subprocess")
+
+    def test_convert(self):
+        with k3down2.PandocServer(command=standin_command) as server:
+            with self.assertLogs("k3down2.pandoc_server", level="WARNING") as cm:
+                self.assertEqual("<p>a</p>\n", server.convert("a"))
+            self.assertIn("all network interfaces", cm.output[0])
+            self.assertEqual("<p>b</p>\n<!-- columns 100 -->\n", server.convert("b", {"columns": 100}))
+
+            with concurrent.futures.ThreadPoolExecutor(8) as pool:
+                got = list(pool.map(server.convert, [str(i) for i in range(40)]))
+            self.assertEqual(["<p>%d</p>\n" % i for i in range(40)], got)
+
+            st = server.stats()
+            self.assertEqual(1, st["launches"])
+            self.assertEqual(42, st["requests"])
+            # Connections are reused.
+            self.assertLessEqual(st["connections"], 9)
+
+    def test_restart(self):
+        with k3down2.PandocServer(command=standin_command, max_restarts=1) as server:
+            server.start()
+
+            server._proc.kill()
+            server._proc.wait()
+            self.assertEqual("<p>a</p>\n", server.convert("a"))
+            self.assertEqual(1, server.stats()["restarts"])
+
+            server._proc.kill()
+            server._proc.wait()
+            with self.assertRaises(PandocServerError):
+                server.convert("a")
+            self.assertFalse(server.available)
+
+    def test_unavailable(self):
+        server = k3down2.PandocServer(command=(sys.executable, "-c", "import sys; sys.exit(3)"))
+        with self.assertLogs("k3down2.pandoc_server", level="WARNING"):
+            with self.assertRaises(PandocServerError):
+                server.start()
+        self.assertFalse(server.available)
+        with self.assertRaises(PandocServerError):
+            server.convert("a")
+
+        self.assertRaises(ValueError, k3down2.PandocServer, pool_size=-1)
+
+    def test_set_pandoc_backend(self):
+        server = k3down2.PandocServer(command=standin_command)
+        k3down2.set_pandoc_backend(server)
+        k3down2.warmup(browser=False, tools=("pandoc",))
+        self.assertEqual(1, server.stats()["launches"])
+
+        self.assertEqual(down2.html_style + "<p>x</p>\n", k3down2.md_to_html("x"))
+        self.assertEqual("<p>x</p>\n<!-- columns 100000 -->", k3down2.mdtable_to_barehtml("x"))
+        self.assertEqual(2, server.stats()["requests"])
+
+        k3down2.set_pandoc_backend("subprocess")
+        self.assertIsNone(server._proc)
+
+        self.assertRaises(ValueError, k3down2.set_pandoc_backend, "foo")
+
+    def test_fallback(self):
+        k3down2.set_pandoc_backend("server", command=(sys.executable, "-c", "import sys; sys.exit(3)"))
+        with self.assertLogs("k3down2.pandoc_server", level="WARNING"):
+            got = k3down2.md_to_html("x")
+        self.assertEqual(down2.html_style + "<p>x</p>\n", got)